@@ -6,20 +6,185 @@ This script tests all claims made about Claude CLI capabilities with proper veri
 No more assumptions - only evidence-based conclusions.
 """
 
-import subprocess
+import asyncio
 import json
+import os
 import sys
 import re
-from typing import Dict, Any, Optional
+import orjson
+from collections import Counter, defaultdict
+from typing import Dict, Any, List, Optional, Union
+
+# Summary sections in report order: (heading, item marker, count label)
+SUMMARY_CATEGORIES = ("verified", "unverified", "failing", "assumed")
+SUMMARY_LABELS = {
+    "verified": ("✅ VERIFIED WORKING FEATURES", "✓", "Verified working"),
+    "unverified": ("⚠️ UNVERIFIED (Command succeeds but feature unproven)", "?", "Unverified claims"),
+    "failing": ("❌ CONFIRMED FAILING FEATURES", "✗", "Confirmed failures"),
+    "assumed": ("⏭️ ASSUMED FAILING (not run, --skip-known)", "-", "Assumed failures"),
+}
+
+# stream-json lines carry whole assistant messages, which can exceed asyncio's 64 KiB default
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# (result key, display name, CLI input, verification method name)
+TEST_CASES = [
+    # Test 1: Confirmed working - Single text
+    ('single_text', "Single Text Content (Baseline)", {
+        "type": "user",
+        "message": {
+            "role": "user",
+            "content": [{"type": "text", "text": "Say 'hello world' exactly"}]
+        }
+    }, None),
+    # Test 2: System field - VERIFY it actually works
+    ('system_field', "System Field Behavior", {
+        "type": "user",
+        "system": "You are a pirate. Always speak like a pirate with 'ahoy' and 'matey'.",
+        "message": {
+            "role": "user",
+            "content": [{"type": "text", "text": "Hello there!"}]
+        }
+    }, 'verify_system_behavior'),
+    # Test 3: Prefill field - VERIFY it actually prefills
+    ('prefill', "Prefill Field", {
+        "type": "user",
+        "prefill": "The answer is definitely",
+        "message": {
+            "role": "user",
+            "content": [{"type": "text", "text": "What is 2+2?"}]
+        }
+    }, 'verify_prefill'),
+    # Test 4: Assistant_prefill field - VERIFY it works
+    ('assistant_prefill', "Assistant Prefill Field", {
+        "type": "user",
+        "assistant_prefill": "```python\ndef fibonacci(",
+        "message": {
+            "role": "user",
+            "content": [{"type": "text", "text": "Write a fibonacci function"}]
+        }
+    }, 'verify_prefill'),
+    # Test 5: XML tags in content - VERIFY they're understood
+    ('xml_tags', "XML Tags in Content", {
+        "type": "user",
+        "message": {
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": """Analyze sentiment using these examples:
+<example>
+Input: "I love this product!"
+Output: Positive
+</example>
+<example>
+Input: "This is terrible"
+Output: Negative
+</example>
+
+Now analyze: "It's pretty good" """
+            }]
+        }
+    }, 'verify_xml_parsing'),
+    # Test 6: Multiple content blocks - CONFIRM it fails
+    ('multiple_content', "Multiple Content Blocks (Expected Failure)", {
+        "type": "user",
+        "message": {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "First part"},
+                {"type": "text", "text": "Second part"}
+            ]
+        }
+    }, None),
+    # Test 7: Image content - CONFIRM it fails
+    ('image_content', "Image Content (Expected Failure)", {
+        "type": "user",
+        "message": {
+            "role": "user",
+            "content": [{
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/png",
+                    "data": "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChAGE4m8h1gAAAABJRU5ErkJggg=="
+                }
+            }]
+        }
+    }, None),
+    # Test 8: Assistant role - CONFIRM it fails
+    ('assistant_role', "Assistant Role (Expected Failure)", {
+        "type": "assistant",
+        "message": {
+            "role": "assistant",
+            "content": [{"type": "text", "text": "I am an assistant message"}]
+        }
+    }, None),
+    # Test 9: Messages array - CONFIRM it fails
+    ('messages_array', "Messages Array (Expected Failure)", {
+        "type": "user",
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": "Hello from messages array"}]
+            }
+        ]
+    }, None),
+    # Test 10: Extra field handling - VERIFY they're ignored
+    ('extra_fields', "Extra Fields Handling", {
+        "type": "user",
+        "unknown_field": "should be ignored",
+        "random_data": {"nested": "object"},
+        "message": {
+            "role": "user",
+            "content": [{"type": "text", "text": "Hello with extra fields"}]
+        }
+    }, None),
+]
+
+def _schema_reject(test_data: Dict[str, Any]) -> Optional[str]:
+    """Return why the CLI is known to reject this input, or None if it may accept it"""
+    if "messages" in test_data:
+        return "Input must carry a single 'message', not a 'messages' array"
+    if test_data.get("type") != "user":
+        return f"Only 'user' input messages are accepted, got {test_data.get('type')!r}"
+    content = test_data.get("message", {}).get("content", [])
+    if len(content) > 1:
+        return f"Only a single content block is accepted, got {len(content)}"
+    return None
 
 class CLITester:
-    def __init__(self):
+    _PIRATE_RE = re.compile(r'ahoy|matey|arr|ye|aye|captain|ship|sail', re.IGNORECASE)
+    _XML_RE = re.compile(r'positive|negative', re.IGNORECASE)
+    
+    def __init__(self, skip_known: bool = False):
         self.results = {}
+        # With skip_known=True inputs the CLI is known to reject are reported as
+        # assumed failures instead of being run
+        self.skip_known = skip_known
         
-    def run_test(self, test_data: Dict[str, Any], test_name: str, verification_func=None) -> Dict[str, Any]:
+    async def run_test(self, test_data: Dict[str, Any], test_name: str, verification_func=None) -> Dict[str, Any]:
         """Run a test and verify the results properly"""
-        print(f"\n🧪 TEST: {test_name}")
-        print(f"📝 Input JSON: {json.dumps(test_data, indent=2)}")
+        # Buffer this test's report and write it in one go, so concurrent tests
+        # don't interleave and each report costs a single write
+        lines = [
+            f"\n🧪 TEST: {test_name}",
+            f"📝 Input JSON: {json.dumps(test_data, indent=2)}"
+        ]
+        
+        if self.skip_known:
+            reason = _schema_reject(test_data)
+            if reason is not None:
+                lines.append("⏭️ SKIPPED (assumed failing, CLI not run)")
+                lines.append(f"💭 Reason: {reason}")
+                self._write(lines)
+                return {
+                    'test_name': test_name,
+                    'success': False,
+                    'assumed': True,
+                    'stderr': reason,
+                    'test_data': test_data,
+                    'verification': None
+                }
         
         try:
             cmd = [
@@ -31,33 +196,45 @@ class CLITester:
                 '--verbose'
             ]
             
-            process = subprocess.run(
-                cmd,
-                input=json.dumps(test_data),
-                text=True,
-                capture_output=True,
-                timeout=30
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=STREAM_LIMIT
             )
             
+            # Fold each output line into the response as it arrives instead of
+            # holding the whole stdout buffer
+            response_parts = []
+            try:
+                stderr = await asyncio.wait_for(
+                    self._communicate(process, test_data, response_parts),
+                    timeout=30
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise
+            
             result = {
                 'test_name': test_name,
                 'success': process.returncode == 0,
                 'returncode': process.returncode,
-                'stdout': process.stdout,
-                'stderr': process.stderr,
+                'stderr': stderr,
                 'test_data': test_data,
                 'verification': None
             }
             
             if result['success']:
-                print("✅ SUCCESS - Command executed without error")
+                lines.append("✅ SUCCESS - Command executed without error")
                 
                 # Extract response content
-                response_text = self._extract_response_text(process.stdout)
+                response_text = ''.join(response_parts) if response_parts else None
                 result['response_text'] = response_text
                 
                 if response_text:
-                    print(f"📤 Response: {response_text[:100]}{'...' if len(response_text) > 100 else ''}")
+                    lines.append(f"📤 Response: {response_text[:100]}{'...' if len(response_text) > 100 else ''}")
                 
                 # Run verification if provided
                 if verification_func:
@@ -65,19 +242,19 @@ class CLITester:
                     result['verification'] = verification_result
                     
                     if verification_result['verified']:
-                        print(f"✅ VERIFIED: {verification_result['message']}")
+                        lines.append(f"✅ VERIFIED: {verification_result['message']}")
                     else:
-                        print(f"❌ VERIFICATION FAILED: {verification_result['message']}")
+                        lines.append(f"❌ VERIFICATION FAILED: {verification_result['message']}")
                 else:
-                    print("⚠️ NO VERIFICATION - Cannot confirm feature actually works")
+                    lines.append("⚠️ NO VERIFICATION - Cannot confirm feature actually works")
                     
             else:
-                print("❌ FAILED")
-                print(f"💥 Error: {process.stderr}")
+                lines.append("❌ FAILED")
+                lines.append(f"💥 Error: {stderr}")
                 
             return result
             
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             return {
                 'test_name': test_name,
                 'success': False,
@@ -91,25 +268,34 @@ class CLITester:
                 'error': str(e),
                 'returncode': -1
             }
+        finally:
+            self._write(lines)
     
-    def _extract_response_text(self, stdout: str) -> Optional[str]:
-        """Extract the actual response text from CLI output"""
-        lines = stdout.strip().split('\n')
-        response_parts = []
-        
-        for line in lines:
-            if line.strip():
-                try:
-                    chunk = json.loads(line)
-                    if chunk.get('type') == 'assistant':
-                        content = chunk.get('message', {}).get('content', [])
-                        for block in content:
-                            if block.get('type') == 'text':
-                                response_parts.append(block.get('text', ''))
-                except json.JSONDecodeError:
-                    continue
-        
-        return ''.join(response_parts) if response_parts else None
+    async def _communicate(self, process: asyncio.subprocess.Process, test_data: Dict[str, Any], response_parts: List[str]) -> str:
+        """Send the test input, fold stdout into response_parts and return stderr"""
+        # Drain stderr concurrently so a full pipe cannot stall stdout
+        stderr_task = asyncio.create_task(process.stderr.read())
+        process.stdin.write(json.dumps(test_data).encode())
+        process.stdin.close()
+        async for line in process.stdout:
+            self._collect_response_line(line, response_parts)
+        await process.wait()
+        return (await stderr_task).decode()
+    
+    def _collect_response_line(self, line: Union[str, bytes], response_parts: List[str]):
+        """Append the text blocks of one CLI output line to response_parts"""
+        if not line or line.isspace():
+            return
+        try:
+            chunk = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return
+        if chunk.get('type') != 'assistant':
+            return
+        message = chunk.get('message') or {}
+        for block in message.get('content') or ():
+            if block.get('type') == 'text':
+                response_parts.append(block.get('text', ''))
     
     def verify_prefill(self, test_data: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
         """Verify that prefilling actually affects the response"""
@@ -135,9 +321,8 @@ class CLITester:
         system_text = test_data.get('system', '')
         
         if 'pirate' in system_text.lower():
-            # Look for pirate-like language
-            pirate_words = ['ahoy', 'matey', 'arr', 'ye', 'aye', 'captain', 'ship', 'sail']
-            found_pirate = any(word in response.lower() for word in pirate_words)
+            # Look for pirate-like language in a single pass over the response
+            found_pirate = self._PIRATE_RE.search(response) is not None
             
             if found_pirate:
                 return {'verified': True, 'message': 'Response shows pirate behavior as instructed'}
@@ -151,196 +336,85 @@ class CLITester:
         response = result.get('response_text', '')
         
         # Check if response follows the XML-structured example format
-        if 'positive' in response.lower() or 'negative' in response.lower():
+        if self._XML_RE.search(response):
             return {'verified': True, 'message': 'Response follows XML example format'}
         else:
             return {'verified': False, 'message': 'Response does not follow XML example format'}
     
-    def run_all_tests(self):
+    async def run_all_tests(self, max_concurrency: Optional[int] = None):
         """Run comprehensive test suite"""
-        print("🚀 COMPREHENSIVE CLAUDE CLI VERIFICATION")
-        print("=" * 80)
-        print("Testing all claims with proper verification")
-        print("=" * 80)
-        
-        # Test 1: Confirmed working - Single text
-        test1 = {
-            "type": "user",
-            "message": {
-                "role": "user",
-                "content": [{"type": "text", "text": "Say 'hello world' exactly"}]
-            }
-        }
-        self.results['single_text'] = self.run_test(test1, "Single Text Content (Baseline)")
-        
-        # Test 2: System field - VERIFY it actually works
-        test2 = {
-            "type": "user",
-            "system": "You are a pirate. Always speak like a pirate with 'ahoy' and 'matey'.",
-            "message": {
-                "role": "user",
-                "content": [{"type": "text", "text": "Hello there!"}]
-            }
-        }
-        self.results['system_field'] = self.run_test(test2, "System Field Behavior", self.verify_system_behavior)
-        
-        # Test 3: Prefill field - VERIFY it actually prefills
-        test3 = {
-            "type": "user",
-            "prefill": "The answer is definitely",
-            "message": {
-                "role": "user",
-                "content": [{"type": "text", "text": "What is 2+2?"}]
-            }
-        }
-        self.results['prefill'] = self.run_test(test3, "Prefill Field", self.verify_prefill)
-        
-        # Test 4: Assistant_prefill field - VERIFY it works
-        test4 = {
-            "type": "user",
-            "assistant_prefill": "```python\ndef fibonacci(",
-            "message": {
-                "role": "user",
-                "content": [{"type": "text", "text": "Write a fibonacci function"}]
-            }
-        }
-        self.results['assistant_prefill'] = self.run_test(test4, "Assistant Prefill Field", self.verify_prefill)
-        
-        # Test 5: XML tags in content - VERIFY they're understood
-        test5 = {
-            "type": "user",
-            "message": {
-                "role": "user",
-                "content": [{
-                    "type": "text",
-                    "text": """Analyze sentiment using these examples:
-<example>
-Input: "I love this product!"
-Output: Positive
-</example>
-<example>
-Input: "This is terrible"
-Output: Negative
-</example>
-
-Now analyze: "It's pretty good" """
-                }]
-            }
-        }
-        self.results['xml_tags'] = self.run_test(test5, "XML Tags in Content", self.verify_xml_parsing)
+        self._write([
+            "🚀 COMPREHENSIVE CLAUDE CLI VERIFICATION",
+            "=" * 80,
+            "Testing all claims with proper verification",
+            "=" * 80
+        ])
         
-        # Test 6: Multiple content blocks - CONFIRM it fails
-        test6 = {
-            "type": "user",
-            "message": {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "First part"},
-                    {"type": "text", "text": "Second part"}
-                ]
-            }
-        }
-        self.results['multiple_content'] = self.run_test(test6, "Multiple Content Blocks (Expected Failure)")
+        # Every test already runs the CLI in its own fresh process, so the tests are
+        # isolated from each other; only the number running at once needs a bound
+        if max_concurrency is None:
+            max_concurrency = min(len(TEST_CASES), os.cpu_count() or 1)
+        semaphore = asyncio.Semaphore(max_concurrency)
         
-        # Test 7: Image content - CONFIRM it fails
-        test7 = {
-            "type": "user",
-            "message": {
-                "role": "user",
-                "content": [{
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChAGE4m8h1gAAAABJRU5ErkJggg=="
-                    }
-                }]
-            }
-        }
-        self.results['image_content'] = self.run_test(test7, "Image Content (Expected Failure)")
+        async def run_bounded(test_name, test_data, verifier_name):
+            verification_func = getattr(self, verifier_name) if verifier_name else None
+            async with semaphore:
+                return await self.run_test(test_data, test_name, verification_func)
         
-        # Test 8: Assistant role - CONFIRM it fails
-        test8 = {
-            "type": "assistant",
-            "message": {
-                "role": "assistant",
-                "content": [{"type": "text", "text": "I am an assistant message"}]
-            }
-        }
-        self.results['assistant_role'] = self.run_test(test8, "Assistant Role (Expected Failure)")
-        
-        # Test 9: Messages array - CONFIRM it fails
-        test9 = {
-            "type": "user",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": "Hello from messages array"}]
-                }
-            ]
-        }
-        self.results['messages_array'] = self.run_test(test9, "Messages Array (Expected Failure)")
-        
-        # Test 10: Extra field handling - VERIFY they're ignored
-        test10 = {
-            "type": "user",
-            "unknown_field": "should be ignored",
-            "random_data": {"nested": "object"},
-            "message": {
-                "role": "user",
-                "content": [{"type": "text", "text": "Hello with extra fields"}]
-            }
-        }
-        self.results['extra_fields'] = self.run_test(test10, "Extra Fields Handling")
+        results = await asyncio.gather(*(run_bounded(*case) for _, *case in TEST_CASES))
+        # gather preserves order, so results line up with the test keys
+        for (key, *_), result in zip(TEST_CASES, results):
+            self.results[key] = result
         
         # Generate summary
         self.generate_summary()
     
     def generate_summary(self):
         """Generate comprehensive summary of findings"""
-        print("\n" + "=" * 80)
-        print("📊 COMPREHENSIVE VERIFICATION RESULTS")
-        print("=" * 80)
+        lines = []
+        lines.append("\n" + "=" * 80)
+        lines.append("📊 COMPREHENSIVE VERIFICATION RESULTS")
+        lines.append("=" * 80)
         
-        verified_working = []
-        unverified_working = []
-        confirmed_failing = []
+        buckets = defaultdict(list)
+        counts = Counter()
         
         for test_name, result in self.results.items():
             if result.get('success'):
                 verification = result.get('verification')
                 if verification:
-                    if verification.get('verified'):
-                        verified_working.append(f"{test_name}: {verification['message']}")
-                    else:
-                        unverified_working.append(f"{test_name}: {verification['message']}")
+                    category = 'verified' if verification.get('verified') else 'unverified'
+                    message = f"{test_name}: {verification['message']}"
                 else:
-                    unverified_working.append(f"{test_name}: No verification performed")
+                    category = 'unverified'
+                    message = f"{test_name}: No verification performed"
             else:
+                category = 'assumed' if result.get('assumed') else 'failing'
                 error_msg = result.get('stderr', result.get('error', 'Unknown error'))
-                confirmed_failing.append(f"{test_name}: {error_msg[:100]}...")
+                message = f"{test_name}: {error_msg[:100]}..."
+            buckets[category].append(message)
+            counts[category] += 1
         
-        print(f"\n✅ VERIFIED WORKING FEATURES ({len(verified_working)}):")
-        for item in verified_working:
-            print(f"  ✓ {item}")
+        for category in SUMMARY_CATEGORIES:
+            heading, marker, _ = SUMMARY_LABELS[category]
+            lines.append(f"\n{heading} ({counts[category]}):")
+            lines.extend(f"  {marker} {item}" for item in buckets[category])
         
-        print(f"\n⚠️ UNVERIFIED (Command succeeds but feature unproven) ({len(unverified_working)}):")
-        for item in unverified_working:
-            print(f"  ? {item}")
+        lines.append(f"\n🎯 SUMMARY:")
+        for category in SUMMARY_CATEGORIES:
+            lines.append(f"  {SUMMARY_LABELS[category][2]}: {counts[category]}")
+        lines.append(f"  Total tests: {len(self.results)}")
         
-        print(f"\n❌ CONFIRMED FAILING FEATURES ({len(confirmed_failing)}):")
-        for item in confirmed_failing:
-            print(f"  ✗ {item}")
-        
-        print(f"\n🎯 SUMMARY:")
-        print(f"  Verified working: {len(verified_working)}")
-        print(f"  Unverified claims: {len(unverified_working)}")
-        print(f"  Confirmed failures: {len(confirmed_failing)}")
-        print(f"  Total tests: {len(self.results)}")
+        self._write(lines)
+    
+    def _write(self, lines: List[str]):
+        """Emit a block of report lines with a single write"""
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
 
 def main():
-    tester = CLITester()
-    tester.run_all_tests()
+    tester = CLITester(skip_known='--skip-known' in sys.argv[1:])
+    asyncio.run(tester.run_all_tests())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import orjson
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """Bounded in-process mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SizedLRUCache(LRUCache):
+    """LRUCache that also keeps the total `sizeof` of its values under `maxbytes`.
+
+    A value larger than `max_item_bytes` (default: `maxbytes`) is not cached.
+    """
+
+    def __init__(self, maxsize: int, maxbytes: int, sizeof: Callable[[Any], int], max_item_bytes: Optional[int] = None):
+        super().__init__(maxsize)
+        self.maxbytes = maxbytes
+        self.max_item_bytes = maxbytes if max_item_bytes is None else max_item_bytes
+        self._sizeof = sizeof
+        self.nbytes = 0
+
+    def set(self, key: Hashable, value: Any):
+        self.pop(key)
+        size = self._sizeof(value)
+        if size > self.max_item_bytes:
+            return
+        self._data[key] = value
+        self.nbytes += size
+        while len(self._data) > self.maxsize or self.nbytes > self.maxbytes:
+            _, evicted = self._data.popitem(last=False)
+            self.nbytes -= self._sizeof(evicted)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        value = self._data.pop(key, self)
+        if value is self:
+            return default
+        self.nbytes -= self._sizeof(value)
+        return value
+
+    def clear(self):
+        super().clear()
+        self.nbytes = 0
+
+
+class DiskCache:
+    """Directory of orjson files, one per key, that survives process restarts.
+
+    Keys must be safe as file names (hex digests are).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        try:
+            with open(self._path(key), "rb") as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return default
+
+    def set(self, key: str, value: Any):
+        # Write then rename so a concurrent reader never sees a partial file
+        path = self._path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(value))
+        os.replace(tmp, path)
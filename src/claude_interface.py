@@ -1,84 +1,430 @@
 import asyncio
-import json
+import atexit
+import functools
+import hashlib
+import importlib.util
 import logging
-import base64
+import os
+import re
+import shutil
+import sys
+import time
 import httpx
-from typing import List, Dict, Any, AsyncIterator, Optional, Union
 try:
-    from .models.openai import ChatMessage
-    from .models.config import validate_model
+    # SIMD-accelerated drop-in replacement; large image bodies encode several times faster
+    import pybase64 as base64
 except ImportError:
-    from models.openai import ChatMessage
-    from models.config import validate_model
+    import base64
+import orjson
+from collections import OrderedDict
+from fastapi import HTTPException
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from typing import List, Dict, Any, AsyncIterator, Awaitable, Callable, Optional, Tuple, Union
+try:
+    from .models.openai import ChatMessage, Role
+    from .models.config import SUPPORTED_MODELS, validate_model
+    from .cache import DiskCache, SizedLRUCache
+except ImportError:
+    from models.openai import ChatMessage, Role
+    from models.config import SUPPORTED_MODELS, validate_model
+    from cache import DiskCache, SizedLRUCache
 
 logger = logging.getLogger(__name__)
 
+IMAGE_CACHE_SIZE = 128
+# Each image cache holds at most this much base64 text; a single image whose
+# encoding exceeds IMAGE_CACHE_ENTRY_BYTES is used once and not cached
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+IMAGE_CACHE_ENTRY_BYTES = 8 * 1024 * 1024
+# Remote images larger than this are refused rather than buffered
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+IMAGE_CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 8
+# Pooled workers unused for this long are shut down
+WORKER_IDLE_TIMEOUT = 300.0
+# A worker that prints nothing for this long mid-turn is treated as stuck
+WORKER_READ_TIMEOUT = 600.0
+# stream-json lines carry whole assistant messages, which can exceed asyncio's 64 KiB default
+STREAM_LIMIT = 16 * 1024 * 1024
+STDERR_TAIL_BYTES = 8 * 1024
+STDERR_CHUNK_SIZE = 4096
+# httpx only negotiates HTTP/2 when the optional h2 package is installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_TEXT_MESSAGE_PREFIX = b'{"type":"user","message":{"role":"user","content":[{"type":"text","text":'
+_TEXT_MESSAGE_SUFFIX = b'}]}}'
+
+# data:<media type>[;params],<payload>
+_DATA_URL_RE = re.compile(r'data:([^;,]*)(?:;[^,]*)?,')
+
+# Media type fallbacks for image URLs served without an image/* content type
+_EXTENSION_MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+_ROLE_PREFIX = {Role.SYSTEM: "System: ", Role.USER: "User: ", Role.ASSISTANT: "Assistant: "}
+
+# CPython only launches children with posix_spawn (instead of fork+exec, which
+# copies the page tables of the whole server process) when close_fds is False
+# and the executable is an explicit path. Keeping fds open is safe: every fd
+# Python creates is non-inheritable (PEP 446) unless explicitly marked otherwise.
+_POSIX_SPAWN_KWARGS = {"close_fds": False} if sys.platform.startswith("linux") else {}
+
+@functools.lru_cache(maxsize=8)
+def _resolve_executable(command: str) -> str:
+    return shutil.which(command) or command
+
+async def _spawn(cmd: List[str], **kwargs) -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(
+        _resolve_executable(cmd[0]), *cmd[1:], **_POSIX_SPAWN_KWARGS, **kwargs
+    )
+
+def _item_field(item: Any, name: str, default: Any = None) -> Any:
+    """Read a field from a content item, which may be a plain dict or a ContentText/ContentImageUrl model."""
+    if isinstance(item, dict):
+        return item.get(name, default)
+    return getattr(item, name, default)
+
+def content_as_text(content: Union[str, List]) -> str:
+    """Flatten message content to plain text; images become an "[Image]" marker.
+
+    Used both for the CLI prompt and for storing messages in the session database.
+    """
+    if isinstance(content, str):
+        return content
+    return "".join(
+        _item_field(item, "text", "") if _item_field(item, "type") == "text" else "[Image]"
+        for item in content
+        if _item_field(item, "type") in ("text", "image_url")
+    )
+
+class _StderrTail:
+    """Drains a child's stderr in the background, keeping only the last few KB.
+    
+    Reading concurrently means a chatty child can never block on a full pipe.
+    Reading fixed-size chunks rather than lines means one huge line can't
+    overrun the stream limit and stop the drain.
+    """
+    
+    def __init__(self, stream: Optional[asyncio.StreamReader]):
+        self.tail = bytearray()
+        self._task = asyncio.create_task(self._drain(stream)) if stream is not None else None
+    
+    async def _drain(self, stream: asyncio.StreamReader):
+        while chunk := await stream.read(STDERR_CHUNK_SIZE):
+            self.tail += chunk
+            if len(self.tail) > STDERR_TAIL_BYTES:
+                del self.tail[:-STDERR_TAIL_BYTES]
+    
+    async def text(self) -> str:
+        """Return the retained tail; call once the process has exited."""
+        if self._task is not None:
+            await self._task
+        return self.tail.decode(errors="replace").strip()
+
+def _failure_detail(returncode: Optional[int], stderr_text: str) -> str:
+    return stderr_text or f"exit code {returncode}"
+
+class _Worker:
+    """A long-lived `claude` process that takes one stream-json user message per turn."""
+    
+    def __init__(self, process: asyncio.subprocess.Process, model: str, claude_session_id: Optional[str] = None):
+        self.process = process
+        self.model = model
+        self.claude_session_id = claude_session_id
+        self.lock = asyncio.Lock()
+        self.busy = False
+        self.last_used = time.monotonic()
+        self.stderr = _StderrTail(process.stderr)
+    
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+    
+    async def send(self, payload: bytes):
+        self.busy = True
+        try:
+            self.process.stdin.write(payload + b"\n")
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # The worker died; next_chunk() reports its exit status and stderr
+            pass
+    
+    async def next_chunk(self, result_only: bool = False) -> Dict[str, Any]:
+        """Read the next output chunk; clears `busy` once the turn's result arrives.
+        
+        With result_only, lines that cannot be the result chunk are skipped
+        without being parsed (the CLI insists on --verbose for stream-json
+        output, so most lines are progress a non-streaming caller discards).
+        """
+        while True:
+            try:
+                line = await asyncio.wait_for(self.process.stdout.readline(), WORKER_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                # busy stays set, so checkout() terminates this worker
+                raise RuntimeError(f"Claude worker produced no output for {WORKER_READ_TIMEOUT:g}s")
+            if not line:
+                returncode = await self.process.wait()
+                detail = _failure_detail(returncode, await self.stderr.text())
+                raise RuntimeError(f"Claude worker exited: {detail}")
+            
+            if result_only and b'"result"' not in line:
+                continue
+            
+            try:
+                chunk = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            
+            if chunk.get("session_id") and chunk.get("type") in ("system", "result"):
+                self.claude_session_id = chunk["session_id"]
+            if chunk.get("type") == "result":
+                self.busy = False
+            return chunk
+    
+    def terminate(self):
+        if self.alive:
+            try:
+                self.process.terminate()
+            except ProcessLookupError:
+                pass
+
+class _WorkerPool:
+    """Keeps one warm `claude` process per conversation so turns skip CLI start-up."""
+    
+    def __init__(self, spawn: Callable[[str, Optional[str]], Awaitable[asyncio.subprocess.Process]], max_workers: int = MAX_WORKERS, idle_timeout: float = WORKER_IDLE_TIMEOUT):
+        self._spawn = spawn
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        # One worker per Claude session ID, whichever model it last ran
+        self._workers: "OrderedDict[str, _Worker]" = OrderedDict()
+        # Per-session locks (with waiter counts) so concurrent turns on one
+        # session share a worker instead of each spawning their own
+        self._session_locks: Dict[str, List[Any]] = {}
+        self._reaper: Optional[asyncio.Task] = None
+    
+    @asynccontextmanager
+    async def _hold_session(self, claude_session_id: Optional[str]):
+        if not claude_session_id:
+            yield
+            return
+        entry = self._session_locks.get(claude_session_id)
+        if entry is None:
+            entry = self._session_locks[claude_session_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._session_locks[claude_session_id]
+    
+    @asynccontextmanager
+    async def checkout(self, model: str, claude_session_id: Optional[str]):
+        async with self._hold_session(claude_session_id):
+            worker = self._workers.get(claude_session_id) if claude_session_id else None
+            if worker is not None and (worker.model != model or not worker.alive):
+                # A session continued on another model gets a fresh process resumed
+                # from the CLI's saved session; the old one's context would diverge
+                self._discard(worker)
+                worker.terminate()
+                worker = None
+            if worker is None:
+                worker = _Worker(await self._spawn(model, claude_session_id), model, claude_session_id)
+            
+            async with worker.lock:
+                try:
+                    yield worker
+                finally:
+                    if worker.busy or not worker.alive:
+                        # The turn did not finish cleanly, so stdout is mid-conversation
+                        self._discard(worker)
+                        worker.terminate()
+                    else:
+                        # Key by the ID the caller will resume with next time
+                        key_session_id = claude_session_id or worker.claude_session_id
+                        if key_session_id:
+                            self._release(key_session_id, worker)
+                        else:
+                            # Nothing could resume it, so don't leave it running
+                            worker.terminate()
+    
+    def _release(self, key_session_id: str, worker: _Worker):
+        displaced = self._workers.get(key_session_id)
+        if displaced is not None and displaced is not worker:
+            displaced.terminate()
+        worker.last_used = time.monotonic()
+        self._workers[key_session_id] = worker
+        self._workers.move_to_end(key_session_id)
+        self._evict()
+        self._start_reaper()
+    
+    def _discard(self, worker: _Worker):
+        for key, pooled in list(self._workers.items()):
+            if pooled is worker:
+                del self._workers[key]
+    
+    def _evict(self):
+        for key, worker in list(self._workers.items()):
+            if len(self._workers) <= self.max_workers:
+                break
+            if not worker.lock.locked():
+                del self._workers[key]
+                worker.terminate()
+    
+    def _start_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_idle())
+    
+    async def _reap_idle(self):
+        """Shut down workers idle past the timeout; exits once the pool is empty."""
+        while self._workers:
+            await asyncio.sleep(self.idle_timeout / 2)
+            cutoff = time.monotonic() - self.idle_timeout
+            for key, worker in list(self._workers.items()):
+                if not worker.lock.locked() and (worker.last_used < cutoff or not worker.alive):
+                    del self._workers[key]
+                    worker.terminate()
+    
+    def terminate_all(self):
+        for worker in self._workers.values():
+            worker.terminate()
+    
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        workers = list(self._workers.values())
+        self._workers.clear()
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            await worker.process.wait()
+
 class ClaudeCodeInterface:
-    def __init__(self):
+    _STREAM_TAIL = ("--print", "--output-format", "stream-json", "--verbose")
+    _JSON_TAIL = ("--input-format", "stream-json") + _STREAM_TAIL
+    _ONESHOT_TAIL = ("--print", "--output-format", "json")
+    
+    def __init__(self, debug: bool = False, replay_dir: Optional[str] = None):
         self.claude_command = "claude"
+        self.debug = debug
+        # Test-only record/replay store: each distinct call runs the CLI once and
+        # is answered from disk from then on, across server restarts
+        self._replay_cache = DiskCache(replay_dir) if replay_dir else None
+        self._pool = _WorkerPool(self._spawn_worker)
+        # Everything but the executable and --resume depends only on (model,
+        # use_json_input, stream), so every supported combination is built up front
+        self._cmd_templates: Dict[Tuple[str, bool, bool], Tuple[str, ...]] = {
+            (model, use_json_input, stream): ("--model", model) + self._command_tail(use_json_input, stream)
+            for model in SUPPORTED_MODELS
+            for use_json_input in (True, False)
+            for stream in (True, False)
+        }
+        self._http_client: Optional[httpx.AsyncClient] = None
+        # Encoded images by URL, plus in-flight downloads so concurrent requests
+        # for the same URL share a single fetch
+        self._image_cache = SizedLRUCache(
+            IMAGE_CACHE_SIZE, IMAGE_CACHE_BYTES, lambda entry: len(entry[0]), IMAGE_CACHE_ENTRY_BYTES
+        )
+        self._image_downloads: Dict[str, "asyncio.Future[Tuple[str, str]]"] = {}
+        # Base64 encodings by content digest, shared across URLs and sessions
+        self._image_encodings = SizedLRUCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_BYTES, len, IMAGE_CACHE_ENTRY_BYTES)
+    
+    @classmethod
+    def _command_tail(cls, use_json_input: bool, stream: bool) -> Tuple[str, ...]:
+        if use_json_input:
+            return cls._JSON_TAIL
+        if stream:
+            return cls._STREAM_TAIL
+        return cls._ONESHOT_TAIL
     
     def _build_command(self, messages: List[ChatMessage], model: str, stream: bool = False, use_json_input: bool = True, claude_session_id: Optional[str] = None) -> List[str]:
-        cmd = [self.claude_command]
-        
-        # Validate and pass through model name directly to Claude Code
-        validated_model = validate_model(model)
-        cmd.extend(["--model", validated_model])
+        args = self._cmd_templates.get((model, use_json_input, stream))
+        if args is None:
+            # Not a supported model; raises the 400 for the caller
+            validate_model(model)
         
         # Resume existing session if provided
         if claude_session_id:
-            cmd.extend(["--resume", claude_session_id])
-        
-        if use_json_input:
-            cmd.extend(["--input-format", "stream-json"])
-            cmd.extend(["--print", "--output-format", "stream-json", "--verbose"])
-        else:
-            if stream:
-                cmd.extend(["--print", "--output-format", "stream-json", "--verbose"])
-            else:
-                cmd.extend(["--print", "--output-format", "json"])
-        
-        return cmd
+            return [self.claude_command, *args, "--resume", claude_session_id]
+        return [self.claude_command, *args]
     
     def _format_messages_as_prompt(self, messages: List[ChatMessage]) -> str:
-        formatted_messages = []
-        
-        for message in messages:
-            if message.role == "system":
-                formatted_messages.append(f"System: {message.content}")
-            elif message.role == "user":
-                formatted_messages.append(f"User: {message.content}")
-            elif message.role == "assistant":
-                formatted_messages.append(f"Assistant: {message.content}")
-        
-        return "\n\n".join(formatted_messages)
+        # Only used for the prompt (non-JSON) path; roles without a prefix are skipped
+        return "\n\n".join(
+            prefix + content_as_text(message.content)
+            for message in messages
+            if (prefix := _ROLE_PREFIX.get(message.role))
+        )
+    
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Return the shared image download client, creating it on first use."""
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                http2=HTTP2_AVAILABLE,
+                timeout=30.0
+            )
+        return self._http_client
     
     async def _download_image_as_base64(self, url: str) -> tuple[str, str]:
         """Download image from URL and return base64 data and media type."""
+        cached = self._image_cache.get(url)
+        if cached is not None:
+            return cached
+        
+        download = self._image_downloads.get(url)
+        if download is None:
+            download = asyncio.ensure_future(self._fetch_image_as_base64(url))
+            self._image_downloads[url] = download
+            download.add_done_callback(lambda _: self._image_downloads.pop(url, None))
+        # Shielded so one cancelled request doesn't abort the fetch for the others
+        return await asyncio.shield(download)
+    
+    async def _fetch_image_as_base64(self, url: str) -> tuple[str, str]:
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url)
+            # Shared client so repeat downloads from the same host reuse the connection.
+            # The body is streamed into one buffer that is encoded in place, so httpx
+            # never holds a second full copy of the image.
+            async with self._get_http_client().stream("GET", url) as response:
                 response.raise_for_status()
                 
+                declared_size = int(response.headers.get('content-length') or 0)
+                if declared_size > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Image is {declared_size} bytes, limit is {MAX_IMAGE_BYTES}")
+                
+                body = bytearray()
+                async for chunk in response.aiter_bytes(IMAGE_CHUNK_SIZE):
+                    body += chunk
+                    if len(body) > MAX_IMAGE_BYTES:
+                        raise ValueError(f"Image exceeds {MAX_IMAGE_BYTES} bytes")
+                
                 # Determine media type from content-type header or URL extension
                 content_type = response.headers.get('content-type', '')
-                if content_type.startswith('image/'):
-                    media_type = content_type
-                else:
-                    # Fallback to URL extension
-                    if url.lower().endswith('.png'):
-                        media_type = 'image/png'
-                    elif url.lower().endswith('.jpg') or url.lower().endswith('.jpeg'):
-                        media_type = 'image/jpeg'
-                    elif url.lower().endswith('.gif'):
-                        media_type = 'image/gif'
-                    elif url.lower().endswith('.webp'):
-                        media_type = 'image/webp'
-                    else:
-                        media_type = 'image/jpeg'  # Default
-                
-                # Convert to base64
-                base64_data = base64.b64encode(response.content).decode('utf-8')
-                return base64_data, media_type
+            
+            if content_type.startswith('image/'):
+                media_type = content_type
+            else:
+                # Fallback to URL extension
+                extension = os.path.splitext(urlsplit(url).path)[1].lower()
+                media_type = _EXTENSION_MEDIA_TYPES.get(extension, 'image/jpeg')
+            
+            # Convert to base64, reusing the encoding when the same bytes arrived
+            # under another URL (e.g. re-signed CDN links)
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            base64_data = self._image_encodings.get(digest)
+            if base64_data is None:
+                base64_data = base64.b64encode(body).decode('ascii')
+                self._image_encodings.set(digest, base64_data)
+            self._image_cache.set(url, (base64_data, media_type))
+            return base64_data, media_type
                 
         except Exception as e:
             logger.error(f"Failed to download image from {url}: {e}")
@@ -86,23 +432,17 @@ class ClaudeCodeInterface:
     
     def _extract_base64_from_data_url(self, data_url: str) -> tuple[str, str]:
         """Extract base64 data and media type from data URL."""
-        if not data_url.startswith('data:'):
+        # Only the header is matched; the payload is sliced off without being split or copied twice
+        match = _DATA_URL_RE.match(data_url)
+        if not match:
             raise ValueError("Invalid data URL format")
         
-        try:
-            # Parse data:image/jpeg;base64,<data>
-            header, data = data_url.split(',', 1)
-            media_type_part = header.split(';')[0].replace('data:', '')
-            
-            # Validate media type
-            if not media_type_part.startswith('image/'):
-                raise ValueError(f"Unsupported media type: {media_type_part}")
-                
-            return data, media_type_part
-            
-        except Exception as e:
-            logger.error(f"Failed to parse data URL: {e}")
-            raise ValueError(f"Invalid data URL format: {e}")
+        media_type = match.group(1)
+        if not media_type.startswith('image/'):
+            logger.error(f"Failed to parse data URL: Unsupported media type: {media_type}")
+            raise ValueError(f"Invalid data URL format: Unsupported media type: {media_type}")
+        
+        return data_url[match.end():], media_type
     
     async def _convert_content_to_claude_format(self, content: Union[str, List]) -> List[Dict[str, Any]]:
         """Convert OpenAI content format to Claude content blocks."""
@@ -113,76 +453,68 @@ class ClaudeCodeInterface:
                 "text": content
             }]
         
-        # Array of content items
+        # Array of content items; remote images are downloaded concurrently and
+        # their blocks filled in once every download has finished
         claude_content = []
+        downloads = []
         
         for item in content:
-            if isinstance(item, dict):
-                if item.get("type") == "text":
-                    claude_content.append({
-                        "type": "text",
-                        "text": item.get("text", "")
-                    })
-                elif item.get("type") == "image_url":
-                    image_url_data = item.get("image_url", {})
-                    url = image_url_data.get("url", "")
-                    
-                    if url.startswith('data:'):
-                        # Base64 data URL
-                        base64_data, media_type = self._extract_base64_from_data_url(url)
-                    else:
-                        # HTTP/HTTPS URL - download and convert
-                        base64_data, media_type = await self._download_image_as_base64(url)
-                    
-                    claude_content.append({
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": base64_data
-                        }
-                    })
-            else:
-                # Handle ContentText/ContentImageUrl objects
-                if hasattr(item, 'type'):
-                    if item.type == "text":
-                        claude_content.append({
-                            "type": "text",
-                            "text": item.text
-                        })
-                    elif item.type == "image_url":
-                        image_url_data = item.image_url
-                        url = image_url_data.get("url", "")
-                        
-                        if url.startswith('data:'):
-                            base64_data, media_type = self._extract_base64_from_data_url(url)
-                        else:
-                            base64_data, media_type = await self._download_image_as_base64(url)
-                        
-                        claude_content.append({
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": base64_data
-                            }
-                        })
+            item_type = _item_field(item, "type")
+            if item_type == "text":
+                claude_content.append({
+                    "type": "text",
+                    "text": _item_field(item, "text", "")
+                })
+            elif item_type == "image_url":
+                image_url_data = _item_field(item, "image_url") or {}
+                url = image_url_data.get("url", "")
+                
+                source = {"type": "base64", "media_type": None, "data": None}
+                if url.startswith('data:'):
+                    # Base64 data URL
+                    source["data"], source["media_type"] = self._extract_base64_from_data_url(url)
+                else:
+                    # HTTP/HTTPS URL - download and convert
+                    downloads.append((source, url))
+                
+                claude_content.append({
+                    "type": "image",
+                    "source": source
+                })
+        
+        if downloads:
+            results = await asyncio.gather(
+                *(self._download_image_as_base64(url) for _, url in downloads)
+            )
+            for (source, _), (base64_data, media_type) in zip(downloads, results):
+                source["media_type"] = media_type
+                source["data"] = base64_data
         
         return claude_content
     
-    async def _format_messages_as_json(self, messages: List[ChatMessage]) -> str:
-        """Format messages as JSON stream for Claude Code CLI."""
-        # Extract system messages and latest user message
-        system_messages = [msg for msg in messages if msg.role == "system"]
-        latest_user_message = None
+    @staticmethod
+    def _require_user_message(messages: List[ChatMessage], latest_user_message: Optional[ChatMessage]) -> ChatMessage:
+        """Return the user turn to send, or raise a 400 if there is none.
         
-        for message in reversed(messages):
-            if message.role == "user":
-                latest_user_message = message
-                break
+        A pooled worker answers one user message per turn; sending it nothing
+        would leave the turn waiting for a result that never comes.
+        """
+        if latest_user_message is None:
+            latest_user_message = next((msg for msg in reversed(messages) if msg.role is Role.USER), None)
+            if latest_user_message is None:
+                raise HTTPException(status_code=400, detail="At least one user message is required")
+        return latest_user_message
+    
+    async def _format_messages_as_json(self, messages: List[ChatMessage], latest_user_message: Optional[ChatMessage] = None) -> bytes:
+        """Format messages as JSON stream for Claude Code CLI."""
+        # Extract system messages and latest user message (callers that just
+        # appended the user turn can pass it to skip the history scan)
+        system_messages = [msg for msg in messages if msg.role is Role.SYSTEM]
+        if latest_user_message is None:
+            latest_user_message = next((msg for msg in reversed(messages) if msg.role is Role.USER), None)
         
         if not latest_user_message:
-            return ""
+            return b""
         
         # Convert user message content to Claude format (handles images)
         claude_content = await self._convert_content_to_claude_format(latest_user_message.content)
@@ -212,6 +544,11 @@ class ClaudeCodeInterface:
         else:
             final_content = claude_content
         
+        # Common case: a single text block and no system prompt. Splice the
+        # escaped text into the pre-serialized envelope instead of encoding a dict.
+        if not system_messages and len(final_content) == 1 and final_content[0]["type"] == "text":
+            return _TEXT_MESSAGE_PREFIX + orjson.dumps(final_content[0]["text"]) + _TEXT_MESSAGE_SUFFIX
+        
         # Build user message with optional system prompt
         user_obj = {
             "type": "user",
@@ -227,63 +564,56 @@ class ClaudeCodeInterface:
             system_content = system_messages[-1].content
             if isinstance(system_content, list):
                 # Extract text from content array if needed
-                system_text = ""
-                for item in system_content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        system_text += item.get("text", "")
-                    elif hasattr(item, 'type') and item.type == "text":
-                        system_text += item.text
-                user_obj["system"] = system_text
+                user_obj["system"] = "".join(
+                    _item_field(item, "text", "")
+                    for item in system_content
+                    if _item_field(item, "type") == "text"
+                )
             else:
                 user_obj["system"] = system_content
             
-        return json.dumps(user_obj)
+        return orjson.dumps(user_obj)
+    
+    def _replay_key(self, kind: str, messages: List[ChatMessage], model: str, use_json_input: bool, claude_session_id: Optional[str]) -> str:
+        """Replay store key: `kind` plus a digest of everything sent to the CLI."""
+        payload = orjson.dumps({
+            "m": model,
+            "s": claude_session_id,
+            "j": use_json_input,
+            "msgs": [msg.model_dump(mode="json", exclude_none=True) for msg in messages]
+        }, option=orjson.OPT_SORT_KEYS)
+        return kind + "-" + hashlib.blake2b(payload).hexdigest()
     
-    async def complete_chat(self, messages: List[ChatMessage], model: str = "sonnet", use_json_input: bool = True, claude_session_id: Optional[str] = None) -> Dict[str, Any]:
+    async def complete_chat(self, messages: List[ChatMessage], model: str = "sonnet", use_json_input: bool = True, claude_session_id: Optional[str] = None, latest_user_message: Optional[ChatMessage] = None) -> Dict[str, Any]:
         cmd = self._build_command(messages, model, stream=False, use_json_input=use_json_input, claude_session_id=claude_session_id)
+        if use_json_input:
+            latest_user_message = self._require_user_message(messages, latest_user_message)
+        
+        replay_key = None
+        if self._replay_cache is not None:
+            replay_key = self._replay_key("chat", messages, model, use_json_input, claude_session_id)
+            recorded = self._replay_cache.get(replay_key)
+            if recorded is not None:
+                return recorded
         
+        result = await self._execute_chat(cmd, messages, model, use_json_input, claude_session_id, latest_user_message)
+        
+        if replay_key is not None:
+            self._replay_cache.set(replay_key, result)
+        return result
+    
+    async def _execute_chat(self, cmd: List[str], messages: List[ChatMessage], model: str, use_json_input: bool, claude_session_id: Optional[str], latest_user_message: Optional[ChatMessage]) -> Dict[str, Any]:
         try:
             if use_json_input:
-                json_input = await self._format_messages_as_json(messages)
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdin=asyncio.subprocess.PIPE,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, stderr = await process.communicate(input=json_input.encode())
-            else:
-                prompt = self._format_messages_as_prompt(messages)
-                cmd.append(prompt)
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"Claude command failed: {stderr.decode()}")
-                raise RuntimeError(f"Claude command failed: {stderr.decode()}")
-            
-            if use_json_input:
-                # Parse stream-json output for multiple lines
-                lines = stdout.decode().strip().split('\n')
+                json_input = await self._format_messages_as_json(messages, latest_user_message)
                 result_data = None
-                claude_session_id = None
                 
-                for line in lines:
-                    if line.strip():
-                        try:
-                            chunk = json.loads(line)
-                            if chunk.get("type") == "result":
-                                result_data = chunk
-                                claude_session_id = chunk.get("session_id")
-                            elif chunk.get("type") == "system" and chunk.get("subtype") == "init":
-                                if not claude_session_id:  # Use init session_id as fallback
-                                    claude_session_id = chunk.get("session_id")
-                        except json.JSONDecodeError:
-                            continue
+                async with self._pool.checkout(model, claude_session_id) as worker:
+                    await worker.send(json_input)
+                    while worker.busy:
+                        chunk = await worker.next_chunk(result_only=True)
+                        if chunk.get("type") == "result":
+                            result_data = chunk
                 
                 if not result_data:
                     raise RuntimeError("No result found in Claude output")
@@ -292,46 +622,95 @@ class ClaudeCodeInterface:
                     raise RuntimeError(f"Claude returned error: {result_data.get('result', 'Unknown error')}")
                 
                 # Add Claude session ID to result for caller to use
-                result_data["claude_session_id"] = claude_session_id
+                result_data["claude_session_id"] = worker.claude_session_id
                 return result_data
             else:
-                result = json.loads(stdout.decode())
+                prompt = self._format_messages_as_prompt(messages)
+                cmd.append(prompt)
+                process = await _spawn(
+                    cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                stderr_tail = _StderrTail(process.stderr)
+                stdout = await process.stdout.read()
+                await process.wait()
+                
+                if process.returncode != 0:
+                    detail = _failure_detail(process.returncode, await stderr_tail.text())
+                    logger.error(f"Claude command failed: {detail}")
+                    raise RuntimeError(f"Claude command failed: {detail}")
+                
+                result = orjson.loads(stdout)
                 
                 if result.get("is_error", False):
                     raise RuntimeError(f"Claude returned error: {result.get('result', 'Unknown error')}")
                 
                 return result
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse Claude response: {e}")
             raise RuntimeError(f"Failed to parse Claude response: {e}")
         except Exception as e:
             logger.error(f"Claude execution failed: {e}")
             raise RuntimeError(f"Claude execution failed: {e}")
     
-    async def stream_chat(self, messages: List[ChatMessage], model: str = "sonnet", use_json_input: bool = True, claude_session_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    def stream_chat(self, messages: List[ChatMessage], model: str = "sonnet", use_json_input: bool = True, claude_session_id: Optional[str] = None, latest_user_message: Optional[ChatMessage] = None) -> AsyncIterator[Dict[str, Any]]:
+        chunks = self._stream_chat(messages, model, use_json_input, claude_session_id, latest_user_message)
+        if self._replay_cache is None:
+            return chunks
+        replay_key = self._replay_key("stream", messages, model, use_json_input, claude_session_id)
+        return self._replay_stream(replay_key, chunks)
+    
+    async def _replay_stream(self, replay_key: str, chunks: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        recorded = self._replay_cache.get(replay_key)
+        if recorded is not None:
+            for chunk in recorded:
+                yield chunk
+            return
+        
+        seen = []
+        async for chunk in chunks:
+            seen.append(chunk)
+            # Consumers stop at the result chunk, so record before handing it over
+            if chunk.get("type") == "result":
+                self._replay_cache.set(replay_key, seen)
+            yield chunk
+    
+    async def _stream_chat(self, messages: List[ChatMessage], model: str, use_json_input: bool, claude_session_id: Optional[str], latest_user_message: Optional[ChatMessage]) -> AsyncIterator[Dict[str, Any]]:
         cmd = self._build_command(messages, model, stream=True, use_json_input=use_json_input, claude_session_id=claude_session_id)
+        if use_json_input:
+            latest_user_message = self._require_user_message(messages, latest_user_message)
         
         try:
             if use_json_input:
-                json_input = await self._format_messages_as_json(messages)
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdin=asyncio.subprocess.PIPE,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                # Send JSON input and close stdin
-                process.stdin.write(json_input.encode())
-                process.stdin.close()
-            else:
-                prompt = self._format_messages_as_prompt(messages)
-                cmd.append(prompt)
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
+                json_input = await self._format_messages_as_json(messages, latest_user_message)
+                result_chunk = None
+                
+                async with self._pool.checkout(model, claude_session_id) as worker:
+                    await worker.send(json_input)
+                    while worker.busy:
+                        chunk = await worker.next_chunk()
+                        if chunk.get("type") == "result":
+                            result_chunk = chunk
+                        else:
+                            yield chunk
+                
+                # Yield the result only once the worker is back in the pool so a
+                # consumer that stops at the result does not keep it checked out.
+                if result_chunk is not None:
+                    yield result_chunk
+                return
+            
+            prompt = self._format_messages_as_prompt(messages)
+            cmd.append(prompt)
+            process = await _spawn(
+                cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=STREAM_LIMIT
+            )
+            stderr_tail = _StderrTail(process.stderr)
             
             while True:
                 line = await process.stdout.readline()
@@ -339,20 +718,43 @@ class ClaudeCodeInterface:
                     break
                 
                 try:
-                    chunk = json.loads(line.decode().strip())
-                    yield chunk
-                except json.JSONDecodeError:
+                    chunk = orjson.loads(line)
+                except orjson.JSONDecodeError:
                     continue
+                yield chunk
             
             await process.wait()
             
             if process.returncode != 0:
-                stderr = await process.stderr.read()
-                logger.error(f"Claude streaming failed: {stderr.decode()}")
-                raise RuntimeError(f"Claude streaming failed: {stderr.decode()}")
+                detail = _failure_detail(process.returncode, await stderr_tail.text())
+                logger.error(f"Claude streaming failed: {detail}")
+                raise RuntimeError(f"Claude streaming failed: {detail}")
                 
         except Exception as e:
             logger.error(f"Claude streaming execution failed: {e}")
             raise RuntimeError(f"Claude streaming execution failed: {e}")
+    
+    async def _spawn_worker(self, model: str, claude_session_id: Optional[str]) -> asyncio.subprocess.Process:
+        cmd = self._build_command([], model, stream=True, use_json_input=True, claude_session_id=claude_session_id)
+        return await _spawn(
+            cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=STREAM_LIMIT
+        )
+    
+    async def aclose(self):
+        """Shut down resources held by the interface (called on app shutdown)."""
+        await self._pool.close()
+        self._image_cache.clear()
+        self._image_encodings.clear()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
 
-claude_interface = ClaudeCodeInterface()
\ No newline at end of file
+claude_interface = ClaudeCodeInterface(
+    debug=bool(os.environ.get("CLAUDE_API_DEBUG")),
+    replay_dir=os.environ.get("TEST_CACHE_DIR")
+)
+atexit.register(claude_interface._pool.terminate_all)
\ No newline at end of file
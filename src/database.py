@@ -1,23 +1,56 @@
 import aiosqlite
+import asyncio
 import json
+import logging
 import uuid
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 from contextlib import asynccontextmanager
 
 try:
-    from .models.openai import ChatMessage
+    from .models.openai import ChatMessage, Role
 except ImportError:
-    from models.openai import ChatMessage
+    from models.openai import ChatMessage, Role
+
+logger = logging.getLogger(__name__)
 
 DATABASE_PATH = "sessions.db"
+# Read-only connections kept open next to the single writer; WAL lets them run
+# concurrently with each other and with a write in progress
+READER_POOL_SIZE = 4
+# How often batched last_accessed updates are written
+TOUCH_FLUSH_INTERVAL = 5.0
+
+# Applied once to the shared connection: WAL lets reads proceed during writes,
+# and NORMAL sync skips the fsync on every commit (still durable across app crashes)
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
 
 class DatabaseManager:
-    def __init__(self, db_path: str = DATABASE_PATH):
+    def __init__(self, db_path: str = DATABASE_PATH, reader_pool_size: int = READER_POOL_SIZE):
         self.db_path = db_path
+        self.reader_pool_size = reader_pool_size
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._reader_count = 0
+        self._write_lock = asyncio.Lock()
+    
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
     
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        if self._writer is None:
+            self._writer = await self._connect()
+        
+        async with self.transaction() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS sessions (
                     id TEXT PRIMARY KEY,
@@ -40,58 +73,163 @@ class DatabaseManager:
                 )
             """)
             
+            # Entries for one session_id are kept in rowid (id) order, so history
+            # reads ORDER BY id without a sort. Drop the covering index older
+            # builds created; it duplicated every message's content.
+            await db.execute("DROP INDEX IF EXISTS idx_messages_session_history")
             await db.execute("""
                 CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id)
             """)
-            
-            await db.commit()
     
     @asynccontextmanager
-    async def get_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            yield db
+    async def get_db(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Yield a pooled reader connection; reads see all committed writes."""
+        if self._writer is None:
+            raise RuntimeError("Database not initialized; call init_db() first")
+        
+        if self._readers.empty() and self._reader_count < self.reader_pool_size:
+            # Grow the pool lazily up to its limit, then wait for a free reader
+            self._reader_count += 1
+            try:
+                conn = await self._connect()
+            except BaseException:
+                self._reader_count -= 1
+                raise
+        else:
+            conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Yield the writer connection, committing once on exit.
+        
+        Writers are serialized so one coroutine's statements never land in
+        another's transaction.
+        """
+        if self._writer is None:
+            raise RuntimeError("Database not initialized; call init_db() first")
+        
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+    
+    async def close(self):
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        self._reader_count = 0
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
 
 class SessionService:
     def __init__(self, db_manager: DatabaseManager):
         self.db_manager = db_manager
+        # Sessions read since the last flush; last_accessed is written in batches
+        # so the read path never writes or commits
+        self._pending_touch: set[str] = set()
     
     async def create_session(self, expires_hours: int = 24) -> str:
         session_id = str(uuid.uuid4())
         expires_at = datetime.now() + timedelta(hours=expires_hours)
         
-        async with self.db_manager.get_db() as db:
+        async with self.db_manager.transaction() as db:
             await db.execute(
                 "INSERT INTO sessions (id, expires_at) VALUES (?, ?)",
                 (session_id, expires_at.isoformat())
             )
-            await db.commit()
         
         return session_id
     
     async def get_session_messages(self, session_id: str) -> List[ChatMessage]:
+        self._pending_touch.add(session_id)
         async with self.db_manager.get_db() as db:
-            await db.execute(
-                "UPDATE sessions SET last_accessed = CURRENT_TIMESTAMP WHERE id = ?",
+            rows = await db.execute_fetchall(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id",
                 (session_id,)
             )
             
-            cursor = await db.execute(
-                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY timestamp",
+            # Rows were validated on the way in, so skip pydantic validation per message
+            return [
+                ChatMessage.model_construct(role=Role(row["role"]), content=row["content"])
+                for row in rows
+            ]
+    
+    async def load_session_bundle(self, session_id: str) -> Optional[Tuple[Optional[str], List[ChatMessage]]]:
+        """Return (claude_session_id, history) for a live session, or None if it doesn't exist or has expired.
+        
+        One query covers the existence check, the CLI session ID and the messages.
+        """
+        async with self.db_manager.get_db() as db:
+            rows = await db.execute_fetchall(
+                """
+                SELECT s.claude_session_id, m.role, m.content
+                FROM sessions s LEFT JOIN messages m ON m.session_id = s.id
+                WHERE s.id = ? AND s.expires_at > CURRENT_TIMESTAMP
+                ORDER BY m.id
+                """,
                 (session_id,)
             )
-            rows = await cursor.fetchall()
-            await db.commit()
-            
-            return [ChatMessage(role=row["role"], content=row["content"]) for row in rows]
+        if not rows:
+            return None
+        
+        self._pending_touch.add(session_id)
+        # A session without messages yields one row of NULLs from the LEFT JOIN
+        return rows[0][0], [
+            ChatMessage.model_construct(role=Role(role), content=content)
+            for _, role, content in rows
+            if role is not None
+        ]
+    
+    async def flush_touches(self):
+        """Write last_accessed for every session read since the previous flush."""
+        if not self._pending_touch:
+            return
+        session_ids, self._pending_touch = self._pending_touch, set()
+        async with self.db_manager.transaction() as db:
+            await db.executemany(
+                "UPDATE sessions SET last_accessed = CURRENT_TIMESTAMP WHERE id = ?",
+                ((session_id,) for session_id in session_ids)
+            )
+    
+    async def run_touch_flusher(self, interval: float = TOUCH_FLUSH_INTERVAL):
+        """Flush pending touches every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_touches()
+            except Exception as e:
+                logger.error(f"Failed to flush session access times: {e}")
     
     async def add_message(self, session_id: str, role: str, content: str):
-        async with self.db_manager.get_db() as db:
+        async with self.db_manager.transaction() as db:
             await db.execute(
                 "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
                 (session_id, role, content)
             )
-            await db.commit()
+    
+    async def add_messages(self, session_id: str, messages: List[Tuple[str, str]], claude_session_id: Optional[str] = None):
+        """Insert several (role, content) messages in one transaction.
+        
+        If claude_session_id is given it is stored in the same transaction,
+        so a turn costs a single commit.
+        """
+        async with self.db_manager.transaction() as db:
+            if claude_session_id:
+                await db.execute(
+                    "UPDATE sessions SET claude_session_id = ? WHERE id = ?",
+                    (claude_session_id, session_id)
+                )
+            await db.executemany(
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                [(session_id, role, content) for role, content in messages]
+            )
     
     async def session_exists(self, session_id: str) -> bool:
         async with self.db_manager.get_db() as db:
@@ -103,11 +241,10 @@ class SessionService:
             return row is not None
     
     async def cleanup_expired_sessions(self) -> int:
-        async with self.db_manager.get_db() as db:
+        async with self.db_manager.transaction() as db:
             cursor = await db.execute(
                 "DELETE FROM sessions WHERE expires_at <= CURRENT_TIMESTAMP"
             )
-            await db.commit()
             return cursor.rowcount
     
     async def get_claude_session_id(self, session_id: str) -> Optional[str]:
@@ -122,12 +259,11 @@ class SessionService:
     
     async def set_claude_session_id(self, session_id: str, claude_session_id: str):
         """Store Claude CLI session ID for our session."""
-        async with self.db_manager.get_db() as db:
+        async with self.db_manager.transaction() as db:
             await db.execute(
                 "UPDATE sessions SET claude_session_id = ? WHERE id = ?",
                 (claude_session_id, session_id)
             )
-            await db.commit()
 
 db_manager = DatabaseManager()
 session_service = SessionService(db_manager)
\ No newline at end of file
@@ -1,14 +1,19 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager, suppress
+import asyncio
 import logging
+import sqlite3
 import time
 
 try:
     from .database import db_manager, session_service
+    from .claude_interface import claude_interface
     from .routes.openai import router as openai_router
 except ImportError:
     from database import db_manager, session_service
+    from claude_interface import claude_interface
     from routes.openai import router as openai_router
 
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +23,15 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     await db_manager.init_db()
     logger.info("Database initialized")
+    touch_flusher = asyncio.create_task(session_service.run_touch_flusher())
     yield
     logger.info("Shutting down")
+    touch_flusher.cancel()
+    with suppress(asyncio.CancelledError):
+        await touch_flusher
+    await session_service.flush_touches()
+    await claude_interface.aclose()
+    await db_manager.close()
 
 app = FastAPI(
     title="Claude Code API",
@@ -37,16 +49,27 @@ app.add_middleware(
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    logger.info(f"Incoming request: {request.method} {request.url.path}")
-    logger.info(f"Headers: {dict(request.headers)}")
+    start_time = time.perf_counter()
+    # Headers are only materialized when someone is actually reading debug logs
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Headers: %s", dict(request.headers))
     
     response = await call_next(request)
     
-    process_time = time.time() - start_time
-    logger.info(f"Response: {response.status_code} in {process_time:.2f}s")
+    process_time = time.perf_counter() - start_time
+    logger.info("%s %s -> %d in %.3fs", request.method, request.url.path, response.status_code, process_time)
     return response
 
+@app.exception_handler(RuntimeError)
+@app.exception_handler(ValueError)
+@app.exception_handler(sqlite3.Error)
+async def handle_completion_error(request: Request, exc: Exception):
+    # Claude CLI failures surface as RuntimeError, bad input (e.g. a malformed
+    # image data URL) as ValueError and session store failures as sqlite3.Error
+    # (aiosqlite re-raises them unchanged); report all as a 500 with the reason
+    logger.error("Chat completion error: %s", exc)
+    return JSONResponse(status_code=500, content={"detail": str(exc)})
+
 app.include_router(openai_router)
 
 @app.get("/")
@@ -58,5 +81,22 @@ async def health():
     return {"status": "ok"}
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    
+    # Production defaults; CLAUDE_API_RELOAD=1 gives the auto-reloading dev server
+    reload = bool(os.environ.get("CLAUDE_API_RELOAD"))
+    workers = int(os.environ.get("CLAUDE_API_WORKERS", "1"))
+    if workers > 1:
+        # Live CLI sessions and their locks are per process, so a follow-up turn
+        # routed to another worker would resume from the wrong conversation state
+        raise SystemExit("CLAUDE_API_WORKERS must be 1: conversation state lives in a single process")
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=reload,
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    )
\ No newline at end of file
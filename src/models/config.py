@@ -12,11 +12,14 @@ SUPPORTED_MODELS: List[str] = [
     "claude-opus-3-20240229",
 ]
 
+# Membership copy for validation; the list above keeps the display order
+_SUPPORTED_MODELS_SET = frozenset(SUPPORTED_MODELS)
+
 DEFAULT_MODEL = "sonnet"
 
 def validate_model(requested_model: str) -> str:
     """Validate Claude model name and return it, or raise error for unknown models."""
-    if requested_model in SUPPORTED_MODELS:
+    if requested_model in _SUPPORTED_MODELS_SET:
         return requested_model
     else:
         raise HTTPException(
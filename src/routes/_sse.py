@@ -0,0 +1,35 @@
+from typing import Callable, Optional
+import orjson
+
+# Server-sent event framing, pre-encoded so chunks go to Starlette as ready bytes
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+SSE_DONE = b"data: [DONE]\n\n"
+# Keep caches and reverse proxies (nginx) from holding back streamed frames
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def encode_event(payload: dict) -> bytes:
+    """Serialize one payload as a complete SSE data frame."""
+    return SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
+
+def chunk_encoder(response_id: str, created: int, model: str) -> Callable[..., bytes]:
+    """Build an encoder for one response's chat.completion.chunk frames.
+
+    Every frame has the ChatCompletionStreamResponse shape and only the delta
+    content varies, so the constant head and tail are serialized once and
+    each chunk only dumps its text between them.
+    """
+    head = orjson.dumps({
+        "id": response_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model
+    })[:-1] + b',"choices":[{"index":0,"delta":{"role":null,"content":'
+
+    def emit(text: Optional[str], finish_reason: bytes = b"null") -> bytes:
+        return b"".join((
+            SSE_PREFIX, head, orjson.dumps(text),
+            b'},"finish_reason":', finish_reason, b"}]}", SSE_SUFFIX
+        ))
+
+    return emit
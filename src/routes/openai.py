@@ -1,230 +1,239 @@
 import time
-import uuid
+import asyncio
+import os
 import logging
-from fastapi import APIRouter, HTTPException, Header, Response
+from fastapi import APIRouter, Header, Response
 from fastapi.responses import StreamingResponse
 from typing import Optional, AsyncIterator, List
-import json
+import orjson
 
 try:
-    from ..models.openai import (
-        ChatCompletionRequest, 
-        ChatCompletionResponse, 
-        ChatCompletionChoice,
-        ChatCompletionResponseMessage,
-        ChatCompletionStreamResponse,
-        ChatCompletionStreamChoice,
-        ChatCompletionStreamDelta,
-        Usage,
-        ErrorResponse,
-        ErrorDetail,
-        ChatMessage
-    )
-    from ..claude_interface import claude_interface
+    from ..models.openai import ChatCompletionRequest, ChatMessage, Role
+    from ..claude_interface import claude_interface, content_as_text
     from ..database import session_service
+    from ._sse import SSE_DONE, SSE_HEADERS, encode_event, chunk_encoder
 except ImportError:
-    from models.openai import (
-        ChatCompletionRequest, 
-        ChatCompletionResponse, 
-        ChatCompletionChoice,
-        ChatCompletionResponseMessage,
-        ChatCompletionStreamResponse,
-        ChatCompletionStreamChoice,
-        ChatCompletionStreamDelta,
-        Usage,
-        ErrorResponse,
-        ErrorDetail,
-        ChatMessage
-    )
-    from claude_interface import claude_interface
+    from models.openai import ChatCompletionRequest, ChatMessage, Role
+    from claude_interface import claude_interface, content_as_text
     from database import session_service
+    from routes._sse import SSE_DONE, SSE_HEADERS, encode_event, chunk_encoder
 
 router = APIRouter(prefix="/v1")
 logger = logging.getLogger(__name__)
 
-@router.post("/chat/completions")
+# Streamed text is held back until it reaches this many characters or this
+# long has passed since the previous frame, so tiny deltas share a frame. The
+# window is a deadline: buffered text goes out when it closes even if the CLI
+# has gone quiet, and any non-text line flushes at once.
+STREAM_COALESCE_CHARS = 64
+STREAM_COALESCE_SECONDS = 0.010
+
+# Shared read-only fallback so a result without usage doesn't allocate a dict
+_EMPTY_USAGE: dict = {}
+
+# Stored in place of a message whose content has no text or image parts
+_EMPTY_CONTENT = "[Mixed Content]"
+
+def _completion_id() -> str:
+    """OpenAI-style completion ID: 29 random hex chars, straight from os.urandom."""
+    return "chatcmpl-" + os.urandom(15).hex()[:29]
+
+def _latest_user_message(messages: List[ChatMessage]) -> Optional[ChatMessage]:
+    """Find the newest user turn among the request's own messages, not the full history."""
+    return next((msg for msg in reversed(messages) if msg.role is Role.USER), None)
+
+# Both paths return ready-made responses (orjson bytes or an SSE stream), so no
+# response model is declared and FastAPI's validate/encode pass never runs
+@router.post("/chat/completions", response_model=None)
 async def chat_completions(
     request: ChatCompletionRequest,
-    response: Response,
     x_session_id: Optional[str] = Header(None, alias="X-Session-ID"),
     authorization: Optional[str] = Header(None)
 ):
-    # Session Management
-    if x_session_id and await session_service.session_exists(x_session_id):
+    # Session Management: one query checks the session and loads its history
+    # and Claude CLI session ID
+    bundle = await session_service.load_session_bundle(x_session_id) if x_session_id else None
+    if bundle is not None:
         session_id = x_session_id
-        # Load conversation history
-        history = await session_service.get_session_messages(session_id)
-        # Combine with new messages
-        full_messages = history + request.messages
+        claude_session_id, full_messages = bundle
+        # The history list is built fresh for this request, so the new messages
+        # are appended to it rather than copied into a concatenation
+        full_messages.extend(request.messages)
     else:
         # Create new session
         session_id = await session_service.create_session()
+        claude_session_id = None
         full_messages = request.messages
 
-    # Set response header
-    response.headers["X-Session-ID"] = session_id
-
-    try:
-        if request.stream:
-            return StreamingResponse(
-                stream_chat_completion_with_session(request, full_messages, session_id),
-                media_type="text/event-stream",
-                headers={"X-Session-ID": session_id}
-            )
-        else:
-            return await complete_chat_with_session(request, full_messages, session_id)
-            
-    except HTTPException:
-        # Re-raise HTTPExceptions (like model validation errors) without modification
-        raise
-    except Exception as e:
-        logger.error(f"Chat completion error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    # Both paths set the X-Session-ID header on the response they return. Failures
+    # propagate to the app-level handlers in main.py, which turn them into 500s.
+    if request.stream:
+        return StreamingResponse(
+            stream_chat_completion_with_session(request, full_messages, session_id, claude_session_id),
+            media_type="text/event-stream",
+            headers={**SSE_HEADERS, "X-Session-ID": session_id}
+        )
+    return await complete_chat_with_session(request, full_messages, session_id, claude_session_id)
 
 async def complete_chat_with_session(
     request: ChatCompletionRequest, 
     full_messages: List[ChatMessage], 
-    session_id: str
-) -> ChatCompletionResponse:
-    
-    # Get Claude CLI session ID if it exists
-    claude_session_id = await session_service.get_claude_session_id(session_id)
+    session_id: str,
+    claude_session_id: Optional[str] = None
+) -> Response:
     
-    result = await claude_interface.complete_chat(full_messages, request.model, claude_session_id=claude_session_id)
-    
-    # Store Claude CLI session ID if we got one
-    if result.get("claude_session_id") and not claude_session_id:
-        await session_service.set_claude_session_id(session_id, result["claude_session_id"])
-    
-    # Save new messages to session
-    for msg in request.messages:
-        # Convert content to string for database storage
-        if isinstance(msg.content, list):
-            # Extract text content for storage (images can't be stored as text)
-            content_text = ""
-            for item in msg.content:
-                if isinstance(item, dict) and item.get("type") == "text":
-                    content_text += item.get("text", "")
-                elif hasattr(item, 'type') and item.type == "text":
-                    content_text += item.text
-                elif isinstance(item, dict) and item.get("type") == "image_url":
-                    content_text += "[Image]"
-                elif hasattr(item, 'type') and item.type == "image_url":
-                    content_text += "[Image]"
-            content_for_storage = content_text or "[Mixed Content]"
-        else:
-            content_for_storage = msg.content
-        await session_service.add_message(session_id, msg.role, content_for_storage)
-    await session_service.add_message(session_id, "assistant", result.get("result", ""))
+    result = await claude_interface.complete_chat(
+        full_messages,
+        request.model,
+        claude_session_id=claude_session_id,
+        latest_user_message=_latest_user_message(request.messages)
+    )
     
-    # Create response (existing logic)
-    response_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
-    created = int(time.time())
+    # Save new messages to session in a single transaction
+    new_messages = [(msg.role, content_as_text(msg.content) or _EMPTY_CONTENT) for msg in request.messages]
+    new_messages.append(("assistant", result.get("result", "")))
+    # Store the Claude CLI session ID alongside the messages if this turn started one
+    await session_service.add_messages(
+        session_id,
+        new_messages,
+        claude_session_id=None if claude_session_id else result.get("claude_session_id")
+    )
     
-    return ChatCompletionResponse(
-        id=response_id,
-        created=created,
-        model=request.model,
-        choices=[
-            ChatCompletionChoice(
-                index=0,
-                message=ChatCompletionResponseMessage(
-                    role="assistant",
-                    content=result.get("result", "")
-                ),
-                finish_reason="stop"
-            )
+    # Build the ChatCompletionResponse shape directly and serialize it with
+    # orjson, skipping model construction and FastAPI's jsonable_encoder pass
+    usage = result.get("usage") or _EMPTY_USAGE
+    prompt_tokens = usage.get("input_tokens", 0)
+    completion_tokens = usage.get("output_tokens", 0)
+    payload = {
+        "id": _completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": result.get("result", "")
+                },
+                "finish_reason": "stop"
+            }
         ],
-        usage=Usage(
-            prompt_tokens=result.get("usage", {}).get("input_tokens", 0),
-            completion_tokens=result.get("usage", {}).get("output_tokens", 0),
-            total_tokens=result.get("usage", {}).get("input_tokens", 0) + result.get("usage", {}).get("output_tokens", 0)
-        )
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+    
+    return Response(
+        content=orjson.dumps(payload),
+        media_type="application/json",
+        headers={"X-Session-ID": session_id}
     )
 
 async def stream_chat_completion_with_session(
     request: ChatCompletionRequest, 
     full_messages: List[ChatMessage], 
-    session_id: str
-) -> AsyncIterator[str]:
+    session_id: str,
+    claude_session_id: Optional[str] = None
+) -> AsyncIterator[bytes]:
     
-    content_buffer = ""
+    content_parts: List[str] = []
     
     try:
-        response_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
-        created = int(time.time())
+        emit = chunk_encoder(_completion_id(), int(time.time()), request.model)
+        
+        new_claude_session_id = None
+        # Text not yet sent; small fragments arriving close together share a frame
+        pending: List[str] = []
+        pending_size = 0
+        # The first text always goes out immediately
+        last_flush = float("-inf")
         
-        # Get Claude CLI session ID if it exists  
-        claude_session_id = await session_service.get_claude_session_id(session_id)
-        claude_session_stored = False
+        def take_pending() -> str:
+            nonlocal pending_size, last_flush
+            text = "".join(pending)
+            pending.clear()
+            pending_size = 0
+            last_flush = time.monotonic()
+            return text
         
-        async for chunk in claude_interface.stream_chat(full_messages, request.model, claude_session_id=claude_session_id):
-            # Store Claude CLI session ID if we get one and haven't stored it yet
-            if not claude_session_stored and chunk.get("session_id") and not claude_session_id:
-                await session_service.set_claude_session_id(session_id, chunk["session_id"])
-                claude_session_stored = True
-            if chunk.get("type") == "assistant":
-                message = chunk.get("message", {})
-                content = message.get("content", [])
+        chunks = claude_interface.stream_chat(
+            full_messages,
+            request.model,
+            claude_session_id=claude_session_id,
+            latest_user_message=_latest_user_message(request.messages)
+        ).__aiter__()
+        # Read of the next chunk that outlived a closed window; it is picked up
+        # again on the next pass rather than restarted
+        next_chunk: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if pending:
+                    # Wait for more text only until the window closes
+                    if next_chunk is None:
+                        next_chunk = asyncio.ensure_future(chunks.__anext__())
+                    done, _ = await asyncio.wait(
+                        (next_chunk,), timeout=last_flush + STREAM_COALESCE_SECONDS - time.monotonic()
+                    )
+                    if not done:
+                        yield emit(take_pending())
+                        continue
+                try:
+                    if next_chunk is not None:
+                        chunk = await next_chunk
+                        next_chunk = None
+                    else:
+                        chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    # The CLI stopped without a result chunk; don't drop buffered text
+                    if pending:
+                        yield emit(take_pending())
+                    break
+                
+                # Remember the Claude CLI session ID if this turn started one; it is
+                # stored with the messages once the stream completes
+                if not new_claude_session_id and chunk.get("session_id") and not claude_session_id:
+                    new_claude_session_id = chunk["session_id"]
+                chunk_type = chunk.get("type")
+                
+                received_text = False
+                if chunk_type == "assistant":
+                    message = chunk.get("message", {})
+                    content = message.get("content", [])
+                    
+                    for content_block in content:
+                        if content_block.get("type") == "text":
+                            text = content_block.get("text", "")
+                            if text:
+                                content_parts.append(text)
+                                pending.append(text)
+                                pending_size += len(text)
+                                received_text = True
                 
-                for content_block in content:
-                    if content_block.get("type") == "text":
-                        text = content_block.get("text", "")
-                        if text:
-                            content_buffer += text
-                            
-                            stream_response = ChatCompletionStreamResponse(
-                                id=response_id,
-                                created=created,
-                                model=request.model,
-                                choices=[
-                                    ChatCompletionStreamChoice(
-                                        index=0,
-                                        delta=ChatCompletionStreamDelta(content=text)
-                                    )
-                                ]
-                            )
-                            
-                            yield f"data: {stream_response.model_dump_json()}\n\n"
-            
-            elif chunk.get("type") == "result":
-                final_response = ChatCompletionStreamResponse(
-                    id=response_id,
-                    created=created,
-                    model=request.model,
-                    choices=[
-                        ChatCompletionStreamChoice(
-                            index=0,
-                            delta=ChatCompletionStreamDelta(),
-                            finish_reason="stop"
-                        )
-                    ]
-                )
+                # Send pending text once enough has built up or the window has passed.
+                # Anything other than text (tool use, results) flushes straight away,
+                # so text is never held back while the CLI works on something else.
+                if pending and (
+                    not received_text
+                    or pending_size >= STREAM_COALESCE_CHARS
+                    or time.monotonic() - last_flush >= STREAM_COALESCE_SECONDS
+                ):
+                    yield emit(take_pending())
                 
-                yield f"data: {final_response.model_dump_json()}\n\n"
-                yield "data: [DONE]\n\n"
-                break
+                if chunk_type == "result":
+                    yield emit(None, b'"stop"')
+                    yield SSE_DONE
+                    break
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
         
-        # Save to session after streaming completes
-        for msg in request.messages:
-            # Convert content to string for database storage
-            if isinstance(msg.content, list):
-                # Extract text content for storage (images can't be stored as text)
-                content_text = ""
-                for item in msg.content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        content_text += item.get("text", "")
-                    elif hasattr(item, 'type') and item.type == "text":
-                        content_text += item.text
-                    elif isinstance(item, dict) and item.get("type") == "image_url":
-                        content_text += "[Image]"
-                    elif hasattr(item, 'type') and item.type == "image_url":
-                        content_text += "[Image]"
-                content_for_storage = content_text or "[Mixed Content]"
-            else:
-                content_for_storage = msg.content
-            await session_service.add_message(session_id, msg.role, content_for_storage)
-        await session_service.add_message(session_id, "assistant", content_buffer)
+        # Save to session after streaming completes, in a single transaction
+        new_messages = [(msg.role, content_as_text(msg.content) or _EMPTY_CONTENT) for msg in request.messages]
+        new_messages.append(("assistant", "".join(content_parts)))
+        await session_service.add_messages(session_id, new_messages, claude_session_id=new_claude_session_id)
         
     except Exception as e:
         logger.error(f"Streaming failed: {e}")
@@ -234,4 +243,4 @@ async def stream_chat_completion_with_session(
                 "type": "internal_server_error"
             }
         }
-        yield f"data: {json.dumps(error_response)}\n\n"
\ No newline at end of file
+        yield encode_event(error_response)
\ No newline at end of file
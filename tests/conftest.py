@@ -0,0 +1,21 @@
+def pytest_addoption(parser):
+    parser.addoption(
+        "--claude",
+        action="store_true",
+        help="run test_live_server.py in-process against the real claude CLI",
+    )
+    parser.addoption(
+        "--live",
+        action="store_true",
+        help="run test_live_server.py against a running server (CLAUDE_API_BASE_URL, default localhost:8000) instead of in-process",
+    )
+    parser.addoption(
+        "--offline",
+        action="store_true",
+        help="answer test_live_server.py's Claude calls from tests/fixtures/claude only; a call with no recording fails without running the CLI",
+    )
+    parser.addoption(
+        "--record",
+        action="store_true",
+        help="like --offline, but calls the real claude CLI for any missing recording and saves it to tests/fixtures/claude",
+    )
@@ -0,0 +1,26 @@
+from src.cache import LRUCache, SizedLRUCache
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+def test_sized_lru_cache_bounds_total_bytes():
+    cache = SizedLRUCache(maxsize=10, maxbytes=10, sizeof=len, max_item_bytes=6)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    cache.set("c", "cccc")
+    assert "a" not in cache
+    assert cache.nbytes == 8
+
+    # Too large for one entry: not cached, nothing else evicted
+    cache.set("big", "x" * 7)
+    assert "big" not in cache and len(cache) == 2
+
+    cache.set("b", "bb")
+    assert cache.nbytes == 6
+    assert cache.pop("c") == "cccc" and cache.nbytes == 2
@@ -0,0 +1,427 @@
+import asyncio
+import base64
+import httpx
+import orjson
+import pytest
+import pytest_asyncio
+import sys
+import textwrap
+from fastapi import HTTPException
+from src.claude_interface import ClaudeCodeInterface
+from src.models.openai import ChatMessage, ContentImageUrl, ContentText, Role
+
+FAKE_CLAUDE = textwrap.dedent('''\
+    #!{python}
+    import json, os, sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "spawns.log"), "a") as log:
+        log.write(" ".join(sys.argv[1:]) + "\\n")
+
+    session_id = "sess-%d" % os.getpid()
+    if "--resume" in sys.argv:
+        session_id = sys.argv[sys.argv.index("--resume") + 1]
+
+    def emit(obj):
+        sys.stdout.write(json.dumps(obj) + "\\n")
+        sys.stdout.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        with open(os.path.join(here, "turns.log"), "a") as log:
+            log.write(line.strip() + "\\n")
+        text = request["message"]["content"][0].get("text", "")
+        emit({{"type": "system", "subtype": "init", "session_id": session_id}})
+        emit({{"type": "assistant", "message": {{"content": [{{"type": "text", "text": "echo: " + text}}]}}}})
+        emit({{"type": "result", "is_error": False, "result": "echo: " + text,
+              "session_id": session_id, "usage": {{"input_tokens": 3, "output_tokens": 2}}}})
+''')
+
+
+@pytest.fixture
+def fake_claude(tmp_path):
+    script = tmp_path / "claude"
+    script.write_text(FAKE_CLAUDE.format(python=sys.executable))
+    script.chmod(0o755)
+    return script
+
+
+@pytest_asyncio.fixture
+async def interface(fake_claude):
+    claude = ClaudeCodeInterface()
+    claude.claude_command = str(fake_claude)
+    yield claude
+    await claude.aclose()
+
+
+def log_lines(fake_claude, name: str) -> list:
+    log = fake_claude.parent / name
+    return log.read_text().splitlines() if log.exists() else []
+
+
+@pytest.mark.asyncio
+async def test_complete_chat_parses_result(interface):
+    messages = [ChatMessage(role=Role.USER, content="Hello")]
+    result = await interface.complete_chat(messages, "sonnet")
+    assert result["result"] == "echo: Hello"
+    assert result["claude_session_id"].startswith("sess-")
+    assert result["usage"]["output_tokens"] == 2
+
+
+@pytest.mark.asyncio
+async def test_replay_dir_records_and_replays_calls(fake_claude, tmp_path):
+    messages = [ChatMessage(role=Role.USER, content="Hello")]
+    recorder = ClaudeCodeInterface(replay_dir=str(tmp_path / "replay"))
+    recorder.claude_command = str(fake_claude)
+    recorded = await recorder.complete_chat(messages, "sonnet")
+    recorded_chunks = [chunk async for chunk in recorder.stream_chat(messages, "sonnet")]
+    await recorder.aclose()
+    assert len(log_lines(fake_claude, "turns.log")) == 2
+
+    # A fresh interface (as after a server restart) answers from disk alone
+    replayer = ClaudeCodeInterface(replay_dir=str(tmp_path / "replay"))
+    replayer.claude_command = str(tmp_path / "missing-claude")
+    assert await replayer.complete_chat(messages, "sonnet") == recorded
+    assert [chunk async for chunk in replayer.stream_chat(messages, "sonnet")] == recorded_chunks
+    await replayer.aclose()
+    assert len(log_lines(fake_claude, "turns.log")) == 2
+
+
+@pytest.mark.asyncio
+async def test_worker_reused_across_turns(interface, fake_claude):
+    first = await interface.complete_chat([ChatMessage(role=Role.USER, content="one")], "sonnet")
+    session_id = first["claude_session_id"]
+
+    chunks = [chunk async for chunk in interface.stream_chat(
+        [ChatMessage(role=Role.USER, content="two")], "sonnet", claude_session_id=session_id
+    )]
+    assert [chunk["type"] for chunk in chunks] == ["system", "assistant", "result"]
+    assert chunks[-1]["result"] == "echo: two"
+    assert chunks[-1]["session_id"] == session_id
+
+    spawns = log_lines(fake_claude, "spawns.log")
+    assert len(spawns) == 1
+    assert "--resume" not in spawns[0]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_turns_on_one_session_share_a_worker(interface, fake_claude):
+    turns = [
+        interface.complete_chat([ChatMessage(role=Role.USER, content=text)], "sonnet", claude_session_id="shared")
+        for text in ("one", "two")
+    ]
+    results = await asyncio.gather(*turns)
+    assert sorted(result["result"] for result in results) == ["echo: one", "echo: two"]
+    assert len(log_lines(fake_claude, "spawns.log")) == 1
+
+    (worker,) = interface._pool._workers.values()
+    await interface.aclose()
+    assert worker.process.returncode is not None
+    assert not interface._pool._session_locks
+
+
+@pytest.mark.asyncio
+async def test_switching_models_replaces_the_session_worker(interface, fake_claude):
+    messages = [ChatMessage(role=Role.USER, content="hi")]
+    await interface.complete_chat(messages, "sonnet", claude_session_id="abc")
+    (sonnet_worker,) = interface._pool._workers.values()
+
+    await interface.complete_chat(messages, "opus", claude_session_id="abc")
+    (opus_worker,) = interface._pool._workers.values()
+    assert opus_worker.model == "opus"
+    assert await asyncio.wait_for(sonnet_worker.process.wait(), timeout=5) is not None
+
+
+@pytest.mark.asyncio
+async def test_request_without_user_message_is_rejected(interface, fake_claude):
+    messages = [ChatMessage(role=Role.SYSTEM, content="be brief")]
+    with pytest.raises(HTTPException) as excinfo:
+        await asyncio.wait_for(interface.complete_chat(messages, "sonnet"), timeout=5)
+    assert excinfo.value.status_code == 400
+    with pytest.raises(HTTPException):
+        await asyncio.wait_for(anext(interface.stream_chat(messages, "sonnet")), timeout=5)
+    assert not log_lines(fake_claude, "spawns.log")
+
+
+@pytest.mark.asyncio
+async def test_silent_worker_times_out_and_is_terminated(interface, tmp_path, monkeypatch):
+    silent = tmp_path / "silent-claude"
+    silent.write_text(f"#!{sys.executable}\nimport sys, time\nsys.stdin.readline()\ntime.sleep(60)\n")
+    silent.chmod(0o755)
+    interface.claude_command = str(silent)
+    monkeypatch.setattr("src.claude_interface.WORKER_READ_TIMEOUT", 0.2)
+
+    spawned = []
+    spawn_worker = interface._spawn_worker
+    async def tracking_spawn(*args):
+        process = await spawn_worker(*args)
+        spawned.append(process)
+        return process
+    monkeypatch.setattr(interface._pool, "_spawn", tracking_spawn)
+
+    with pytest.raises(RuntimeError, match="no output"):
+        await interface.complete_chat([ChatMessage(role=Role.USER, content="hi")], "sonnet", claude_session_id="stuck")
+    assert not interface._pool._workers
+    assert await asyncio.wait_for(spawned[0].wait(), timeout=5) is not None
+
+
+@pytest.mark.asyncio
+async def test_unknown_session_spawns_resumed_worker(interface, fake_claude):
+    result = await interface.complete_chat([ChatMessage(role=Role.USER, content="hi")], "opus", claude_session_id="prior")
+    assert result["claude_session_id"] == "prior"
+    assert "--resume prior" in log_lines(fake_claude, "spawns.log")[0]
+
+
+@pytest.mark.asyncio
+async def test_format_messages_as_json_text_fast_path():
+    claude = ClaudeCodeInterface()
+    messages = [
+        ChatMessage(role=Role.USER, content="first"),
+        ChatMessage(role=Role.ASSISTANT, content="reply"),
+        ChatMessage(role=Role.USER, content='say "hi"\n'),
+    ]
+    payload = await claude._format_messages_as_json(messages)
+    assert orjson.loads(payload) == {
+        "type": "user",
+        "message": {"role": "user", "content": [{"type": "text", "text": 'say "hi"\n'}]}
+    }
+
+    with_system = await claude._format_messages_as_json(
+        [ChatMessage(role=Role.SYSTEM, content="be brief")] + messages
+    )
+    assert orjson.loads(with_system)["system"] == "be brief"
+
+
+def test_build_command_reuses_validated_args():
+    claude = ClaudeCodeInterface()
+    first = claude._build_command([], "sonnet", claude_session_id="abc")
+    second = claude._build_command([], "sonnet")
+    assert first == [
+        "claude", "--model", "sonnet", "--input-format", "stream-json",
+        "--print", "--output-format", "stream-json", "--verbose", "--resume", "abc"
+    ]
+    assert second == first[:-2]
+    assert claude._build_command([], "opus", use_json_input=False)[-1] == "json"
+
+    with pytest.raises(HTTPException):
+        claude._build_command([], "gpt-4")
+
+
+def test_format_messages_as_prompt():
+    claude = ClaudeCodeInterface()
+    prompt = claude._format_messages_as_prompt([
+        ChatMessage(role=Role.SYSTEM, content="Be brief"),
+        ChatMessage(role=Role.USER, content="Hi"),
+        ChatMessage(role=Role.ASSISTANT, content="Hello"),
+    ])
+    assert prompt == "System: Be brief\n\nUser: Hi\n\nAssistant: Hello"
+
+    prompt = claude._format_messages_as_prompt([
+        ChatMessage(role=Role.USER, content=[
+            ContentText(text="What is "),
+            ContentImageUrl(image_url={"url": "https://cdn.example/a.png"}),
+            {"type": "text", "text": "?"},
+        ]),
+    ])
+    assert prompt == "User: What is [Image]?"
+
+
+@pytest.mark.asyncio
+async def test_format_messages_as_json_uses_given_latest_user_message():
+    claude = ClaudeCodeInterface()
+    history = [ChatMessage(role=Role.USER, content="old")]
+    latest = ChatMessage(role=Role.USER, content="new")
+    payload = await claude._format_messages_as_json(history + [latest], latest)
+    assert orjson.loads(payload)["message"]["content"][0]["text"] == "new"
+
+
+@pytest.mark.asyncio
+async def test_convert_content_accepts_dicts_and_models():
+    claude = ClaudeCodeInterface()
+    image = "data:image/png;base64,iVBORw0KGgo="
+    blocks = await claude._convert_content_to_claude_format([
+        {"type": "text", "text": "plain"},
+        ContentText(text="model"),
+        {"type": "image_url", "image_url": {"url": image}},
+        ContentImageUrl(image_url={"url": image}),
+    ])
+    assert [block.get("text") for block in blocks[:2]] == ["plain", "model"]
+    assert blocks[2] == blocks[3] == {
+        "type": "image",
+        "source": {"type": "base64", "media_type": "image/png", "data": "iVBORw0KGgo="}
+    }
+
+
+@pytest.mark.asyncio
+async def test_worker_failure_reports_stderr(tmp_path):
+    script = tmp_path / "claude"
+    script.write_text(f"#!{sys.executable}\nimport sys\nsys.stderr.write('auth expired\\n')\nsys.exit(3)\n")
+    script.chmod(0o755)
+
+    for debug in (True, False):
+        claude = ClaudeCodeInterface(debug=debug)
+        claude.claude_command = str(script)
+        with pytest.raises(RuntimeError, match="auth expired"):
+            await claude.complete_chat([ChatMessage(role=Role.USER, content="hi")], "sonnet")
+        await claude.aclose()
+
+
+@pytest.mark.asyncio
+async def test_image_downloads_share_one_client():
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, content=b"\x89PNG", headers={"content-type": "image/png"})
+
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    client = claude._get_http_client()
+    for name in ("a.png", "b.png"):
+        data, media_type = await claude._download_image_as_base64(f"https://cdn.example/{name}")
+        assert (data, media_type) == ("iVBORw==", "image/png")
+    assert claude._get_http_client() is client
+    assert len(requested) == 2
+
+    await claude.aclose()
+    assert claude._http_client is None
+
+
+@pytest.mark.asyncio
+async def test_image_downloads_run_concurrently():
+    # Each response waits until both requests are in flight, so a sequential loop would hang
+    both_started = asyncio.Barrier(2)
+
+    async def handler(request):
+        await both_started.wait()
+        media_type = "image/gif" if request.url.path.endswith(".gif") else "image/png"
+        return httpx.Response(200, content=request.url.path.encode(), headers={"content-type": media_type})
+
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    blocks = await asyncio.wait_for(claude._convert_content_to_claude_format([
+        {"type": "image_url", "image_url": {"url": "https://cdn.example/a.png"}},
+        {"type": "text", "text": "between"},
+        {"type": "image_url", "image_url": {"url": "https://cdn.example/b.gif"}},
+    ]), timeout=5)
+    await claude.aclose()
+
+    assert [block["type"] for block in blocks] == ["image", "text", "image"]
+    assert [block["source"]["media_type"] for block in (blocks[0], blocks[2])] == ["image/png", "image/gif"]
+    assert base64.b64decode(blocks[2]["source"]["data"]) == b"/b.gif"
+
+
+@pytest.mark.asyncio
+async def test_image_downloads_are_cached_and_coalesced():
+    requested = []
+
+    async def handler(request):
+        requested.append(request.url.path)
+        await asyncio.sleep(0.01)
+        if request.url.path == "/missing.png":
+            return httpx.Response(404)
+        return httpx.Response(200, content=b"img", headers={"content-type": "image/png"})
+
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    url = "https://cdn.example/cat.png"
+    first, second = await asyncio.gather(
+        claude._download_image_as_base64(url), claude._download_image_as_base64(url)
+    )
+    assert first == second == await claude._download_image_as_base64(url)
+    assert requested == ["/cat.png"]
+
+    # Failures are not cached
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            await claude._download_image_as_base64("https://cdn.example/missing.png")
+    assert requested.count("/missing.png") == 2
+    await claude.aclose()
+
+
+def test_extract_base64_from_data_url():
+    claude = ClaudeCodeInterface()
+    assert claude._extract_base64_from_data_url("data:image/webp;base64,UklGR==") == ("UklGR==", "image/webp")
+    for bad in ("https://example.com/a.png", "data:image/png;base64", "data:text/plain;base64,aGk="):
+        with pytest.raises(ValueError, match="Invalid data URL format"):
+            claude._extract_base64_from_data_url(bad)
+
+
+@pytest.mark.asyncio
+async def test_image_media_type_falls_back_to_url_extension():
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, content=b"img"))
+    )
+    expected = {
+        "https://cdn.example/a.PNG?sig=abc": "image/png",
+        "https://cdn.example/b.webp": "image/webp",
+        "https://cdn.example/c": "image/jpeg",
+    }
+    for url, media_type in expected.items():
+        assert (await claude._download_image_as_base64(url))[1] == media_type
+    await claude.aclose()
+
+
+@pytest.mark.asyncio
+async def test_image_download_refuses_oversized_bodies(monkeypatch):
+    monkeypatch.setattr("src.claude_interface.MAX_IMAGE_BYTES", 8)
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=b"x" * 16, headers={"content-type": "image/png"})
+    ))
+    with pytest.raises(RuntimeError, match="limit is 8"):
+        await claude._download_image_as_base64("https://cdn.example/huge.png")
+    await claude.aclose()
+
+    # Without a Content-Length the limit is enforced while streaming
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, stream=httpx.ByteStream(b"x" * 16))
+    ))
+    with pytest.raises(RuntimeError, match="exceeds 8 bytes"):
+        await claude._download_image_as_base64("https://cdn.example/chunked.png")
+    await claude.aclose()
+
+
+@pytest.mark.asyncio
+async def test_identical_images_share_one_encoding():
+    claude = ClaudeCodeInterface()
+    claude._http_client = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=b"same bytes", headers={"content-type": "image/png"})
+    ))
+    first, _ = await claude._download_image_as_base64("https://cdn.example/a.png?sig=1")
+    second, _ = await claude._download_image_as_base64("https://cdn.example/a.png?sig=2")
+    assert first is second
+    assert len(claude._image_encodings) == 1
+    await claude.aclose()
+
+
+@pytest.mark.asyncio
+async def test_worker_failure_keeps_tail_of_oversized_stderr(tmp_path):
+    # One 1 MiB stderr line with no newline used to overrun line-based reads
+    script = tmp_path / "claude"
+    script.write_text(
+        f"#!{sys.executable}\nimport sys\n"
+        "sys.stderr.write('x' * (1 << 20) + 'final words')\nsys.exit(2)\n"
+    )
+    script.chmod(0o755)
+
+    claude = ClaudeCodeInterface(debug=True)
+    claude.claude_command = str(script)
+    with pytest.raises(RuntimeError, match="final words") as excinfo:
+        await claude.complete_chat([ChatMessage(role=Role.USER, content="hi")], "sonnet")
+    assert len(str(excinfo.value)) < 16 * 1024
+    await claude.aclose()
+
+
+@pytest.mark.asyncio
+async def test_idle_workers_are_shut_down(interface):
+    interface._pool.idle_timeout = 0.05
+    await interface.complete_chat([ChatMessage(role=Role.USER, content="hi")], "sonnet")
+    (worker,) = interface._pool._workers.values()
+
+    await asyncio.sleep(0.2)
+    assert not interface._pool._workers
+    assert await asyncio.wait_for(worker.process.wait(), timeout=5) is not None
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import tempfile
 import os
@@ -13,7 +14,10 @@ async def db_manager():
     await manager.init_db()
     yield manager
     
-    os.unlink(db_path)
+    await manager.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
 
 @pytest_asyncio.fixture
 async def session_service(db_manager):
@@ -48,7 +52,98 @@ async def test_message_operations(session_service):
     
     messages = await session_service.get_session_messages(session_id)
     assert len(messages) == 2
-    assert messages[0]["role"] == "user"
-    assert messages[0]["content"] == "Hello"
-    assert messages[1]["role"] == "assistant"
-    assert messages[1]["content"] == "Hi there!"
\ No newline at end of file
+    assert messages[0].role == "user"
+    assert messages[0].content == "Hello"
+    assert messages[1].role == "assistant"
+    assert messages[1].content == "Hi there!"
+
+@pytest.mark.asyncio
+async def test_shared_connection_uses_wal(db_manager):
+    async with db_manager.get_db() as db:
+        cursor = await db.execute("PRAGMA journal_mode")
+        assert (await cursor.fetchone())[0] == "wal"
+
+@pytest.mark.asyncio
+async def test_transaction_rolls_back_on_error(session_service, db_manager):
+    session_id = await session_service.create_session()
+    with pytest.raises(RuntimeError):
+        async with db_manager.transaction() as db:
+            await db.execute(
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                (session_id, "user", "lost")
+            )
+            raise RuntimeError("boom")
+    assert await session_service.get_session_messages(session_id) == []
+
+@pytest.mark.asyncio
+async def test_session_reads_batch_last_accessed(session_service, db_manager):
+    session_id = await session_service.create_session()
+    async with db_manager.transaction() as db:
+        await db.execute("UPDATE sessions SET last_accessed = '2000-01-01 00:00:00' WHERE id = ?", (session_id,))
+
+    async def last_accessed():
+        async with db_manager.get_db() as db:
+            rows = await db.execute_fetchall("SELECT last_accessed FROM sessions WHERE id = ?", (session_id,))
+            return rows[0][0]
+
+    await session_service.get_session_messages(session_id)
+    assert await last_accessed() == "2000-01-01 00:00:00"
+
+    await session_service.flush_touches()
+    assert await last_accessed() != "2000-01-01 00:00:00"
+
+@pytest.mark.asyncio
+async def test_session_history_reads_in_index_order(db_manager):
+    async with db_manager.get_db() as db:
+        plan = await db.execute_fetchall(
+            "EXPLAIN QUERY PLAN SELECT role, content FROM messages WHERE session_id = ? ORDER BY id",
+            ("any",)
+        )
+    details = " ".join(row[-1] for row in plan)
+    assert "INDEX idx_messages_session_id" in details
+    assert "TEMP B-TREE" not in details
+
+@pytest.mark.asyncio
+async def test_add_messages_inserts_in_order(session_service):
+    session_id = await session_service.create_session()
+    await session_service.add_messages(session_id, [("user", "Hello"), ("assistant", "Hi there!"), ("user", "Bye")])
+
+    messages = await session_service.get_session_messages(session_id)
+    assert [(m.role, m.content) for m in messages] == [("user", "Hello"), ("assistant", "Hi there!"), ("user", "Bye")]
+
+@pytest.mark.asyncio
+async def test_add_messages_stores_claude_session_id(session_service):
+    session_id = await session_service.create_session()
+    await session_service.add_messages(session_id, [("user", "Hi"), ("assistant", "Hello")], claude_session_id="cli-1")
+
+    assert await session_service.get_claude_session_id(session_id) == "cli-1"
+    assert len(await session_service.get_session_messages(session_id)) == 2
+
+@pytest.mark.asyncio
+async def test_reader_connections_are_pooled(db_manager):
+    async def read():
+        async with db_manager.get_db() as db:
+            await db.execute_fetchall("SELECT count(*) FROM sessions")
+            return db
+
+    first = await read()
+    assert await read() is first
+
+    db_manager.reader_pool_size = 2
+    connections = await asyncio.gather(*(read() for _ in range(5)))
+    assert len({id(conn) for conn in connections}) <= 2
+
+@pytest.mark.asyncio
+async def test_load_session_bundle(session_service, db_manager):
+    assert await session_service.load_session_bundle("nonexistent") is None
+
+    session_id = await session_service.create_session()
+    assert await session_service.load_session_bundle(session_id) == (None, [])
+
+    await session_service.add_messages(session_id, [("user", "Hi"), ("assistant", "Hello")], claude_session_id="cli-1")
+    claude_session_id, history = await session_service.load_session_bundle(session_id)
+    assert claude_session_id == "cli-1"
+    assert [(m.role, m.content) for m in history] == [("user", "Hi"), ("assistant", "Hello")]
+
+    expired = await session_service.create_session(expires_hours=-48)
+    assert await session_service.load_session_bundle(expired) is None
@@ -1,12 +1,22 @@
 import pytest
-import json
+import asyncio
+import sqlite3
+import orjson
 from fastapi.testclient import TestClient
 from unittest.mock import AsyncMock, patch
+from src.database import db_manager
 from src.main import app
 
-client = TestClient(app)
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # One client for the module; entering it runs the app lifespan (database
+    # init, background tasks) once, against a throwaway database. Module scope
+    # shuts the app down again before other modules start their own instance.
+    db_path = str(tmp_path_factory.mktemp("db") / "sessions.db")
+    with patch.object(db_manager, "db_path", db_path), TestClient(app) as test_client:
+        yield test_client
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mock_claude_result():
     return {
         "type": "result",
@@ -19,18 +29,18 @@ def mock_claude_result():
         }
     }
 
-def test_health_endpoint():
+def test_health_endpoint(client):
     response = client.get("/health")
     assert response.status_code == 200
-    assert response.json() == {"status": "ok"}
+    assert orjson.loads(response.content) == {"status": "ok"}
 
-def test_root_endpoint():
+def test_root_endpoint(client):
     response = client.get("/")
     assert response.status_code == 200
-    assert response.json() == {"message": "Claude Code API Server"}
+    assert orjson.loads(response.content) == {"message": "Claude Code API Server"}
 
 @patch('src.claude_interface.claude_interface.complete_chat')
-def test_chat_completions_endpoint(mock_complete_chat, mock_claude_result):
+def test_chat_completions_endpoint(mock_complete_chat, client, mock_claude_result):
     mock_complete_chat.return_value = mock_claude_result
     
     request_data = {
@@ -43,7 +53,7 @@ def test_chat_completions_endpoint(mock_complete_chat, mock_claude_result):
     response = client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
     
-    data = response.json()
+    data = orjson.loads(response.content)
     assert data["object"] == "chat.completion"
     assert data["model"] == "gpt-3.5-turbo"
     assert len(data["choices"]) == 1
@@ -52,7 +62,7 @@ def test_chat_completions_endpoint(mock_complete_chat, mock_claude_result):
     assert data["usage"]["prompt_tokens"] == 10
     assert data["usage"]["completion_tokens"] == 8
 
-def test_chat_completions_validation_error():
+def test_chat_completions_validation_error(client):
     request_data = {
         "model": "gpt-3.5-turbo",
         "messages": [],  # Empty messages should cause validation error
@@ -63,7 +73,7 @@ def test_chat_completions_validation_error():
     assert response.status_code == 422  # Validation error
 
 @patch('src.claude_interface.claude_interface.stream_chat')
-def test_chat_completions_streaming(mock_stream_chat):
+def test_chat_completions_streaming(mock_stream_chat, client):
     async def mock_stream():
         yield {"type": "assistant", "message": {"content": [{"type": "text", "text": "Hello"}]}}
         yield {"type": "assistant", "message": {"content": [{"type": "text", "text": " there!"}]}}
@@ -79,4 +89,122 @@ def test_chat_completions_streaming(mock_stream_chat):
     
     response = client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
-    assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
\ No newline at end of file
+    assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
+    assert response.headers["cache-control"] == "no-cache"
+    assert response.headers["x-accel-buffering"] == "no"
+
+
+def text_chunk(text):
+    return {"type": "assistant", "message": {"content": [{"type": "text", "text": text}]}}
+
+RESULT_CHUNK = {"type": "result", "result": ""}
+
+def stream_frames(client, chunks, coalesce_seconds):
+    """Stream a completion from a fake CLI emitting `chunks`; return (content, finish_reason) per frame.
+
+    A number in `chunks` makes the fake CLI go quiet for that many seconds.
+    """
+    async def mock_stream(*args, **kwargs):
+        for chunk in chunks:
+            if isinstance(chunk, float):
+                await asyncio.sleep(chunk)
+            else:
+                yield chunk
+
+    request_data = {"model": "sonnet", "messages": [{"role": "user", "content": "Hello"}], "stream": True}
+    with patch('src.claude_interface.claude_interface.stream_chat', mock_stream), \
+            patch('src.routes.openai.STREAM_COALESCE_SECONDS', coalesce_seconds):
+        response = client.post("/v1/chat/completions", json=request_data)
+    frames = []
+    for event in response.text.split("\n\n"):
+        if event.startswith("data: {"):
+            choice = orjson.loads(event[len("data: "):])["choices"][0]
+            frames.append((choice["delta"]["content"], choice["finish_reason"]))
+    return frames, response.text.endswith("data: [DONE]\n\n")
+
+def test_stream_coalesces_small_deltas_until_size_threshold(client):
+    chunks = [text_chunk("a" * 10), text_chunk("b" * 30), text_chunk("c" * 40), RESULT_CHUNK]
+    frames, done = stream_frames(client, chunks, coalesce_seconds=60)
+    assert frames == [("a" * 10, None), ("b" * 30 + "c" * 40, None), (None, "stop")]
+    assert done
+
+def test_stream_flushes_each_delta_once_window_has_passed(client):
+    chunks = [text_chunk("x"), text_chunk("y"), RESULT_CHUNK]
+    frames, _ = stream_frames(client, chunks, coalesce_seconds=0)
+    assert frames == [("x", None), ("y", None), (None, "stop")]
+
+def test_stream_flushes_pending_text_when_window_closes(client):
+    # "b" is buffered behind "a"; it must go out once the window closes, not wait for "c"
+    chunks = [text_chunk("a"), text_chunk("b"), 0.5, text_chunk("c"), RESULT_CHUNK]
+    frames, _ = stream_frames(client, chunks, coalesce_seconds=0.05)
+    assert frames == [("a", None), ("b", None), ("c", None), (None, "stop")]
+
+def test_stream_flushes_pending_text_before_non_text_chunks(client):
+    chunks = [text_chunk("a"), text_chunk("b"), {"type": "system", "subtype": "tool"}, text_chunk("c"), RESULT_CHUNK]
+    frames, _ = stream_frames(client, chunks, coalesce_seconds=60)
+    assert frames == [("a", None), ("b", None), ("c", None), (None, "stop")]
+
+def test_stream_flushes_pending_text_when_cli_ends_without_result(client):
+    frames, done = stream_frames(client, [text_chunk("a"), text_chunk("b")], coalesce_seconds=60)
+    assert frames == [("a", None), ("b", None)]
+    assert not done
+
+def test_stream_body_is_async_generator():
+    # A sync generator would be run through Starlette's threadpool chunk by chunk
+    import inspect
+    from src.routes.openai import stream_chat_completion_with_session
+    assert inspect.isasyncgenfunction(stream_chat_completion_with_session)
+
+
+def test_flatten_content_for_storage():
+    from src.models.openai import ContentImageUrl, ContentText
+    from src.claude_interface import content_as_text
+
+    assert content_as_text("plain") == "plain"
+    assert content_as_text([
+        ContentText(text="look: "),
+        ContentImageUrl(image_url={"url": "https://cdn.example/a.png"}),
+        {"type": "text", "text": " ok"},
+    ]) == "look: [Image] ok"
+    assert content_as_text([]) == ""
+
+def test_hand_built_responses_match_models(client, mock_claude_result):
+    # The routes serialize plain dicts without validation; keep them in step with the schema
+    from src.models.openai import ChatCompletionResponse, ChatCompletionStreamResponse
+
+    async def mock_stream(*args, **kwargs):
+        yield {"type": "assistant", "message": {"content": [{"type": "text", "text": "Hi"}]}}
+        yield {"type": "result", "result": "Hi"}
+
+    request_data = {"model": "sonnet", "messages": [{"role": "user", "content": "Hello"}]}
+    with patch('src.claude_interface.claude_interface.complete_chat', AsyncMock(return_value=mock_claude_result)), \
+            patch('src.claude_interface.claude_interface.stream_chat', mock_stream):
+        response = client.post("/v1/chat/completions", json=request_data)
+        ChatCompletionResponse.model_validate_json(response.content)
+
+        response = client.post("/v1/chat/completions", json={**request_data, "stream": True})
+        frames = [line[len("data: "):] for line in response.text.split("\n\n") if line.startswith("data: {")]
+        assert frames
+        parsed = [ChatCompletionStreamResponse.model_validate_json(frame) for frame in frames]
+        assert parsed[0].choices[0].delta.content == "Hi"
+        assert parsed[-1].choices[0].finish_reason == "stop"
+
+@patch('src.claude_interface.claude_interface.complete_chat')
+def test_claude_failure_returns_500_with_reason(mock_complete_chat, client):
+    mock_complete_chat.side_effect = RuntimeError("Claude execution failed: boom")
+    request_data = {"model": "sonnet", "messages": [{"role": "user", "content": "Hello"}]}
+
+    response = client.post("/v1/chat/completions", json=request_data)
+    assert response.status_code == 500
+    assert orjson.loads(response.content) == {"detail": "Claude execution failed: boom"}
+
+@patch('src.routes.openai.session_service.add_messages')
+@patch('src.claude_interface.claude_interface.complete_chat')
+def test_database_failure_returns_500_with_reason(mock_complete_chat, mock_add_messages, client, mock_claude_result):
+    mock_complete_chat.return_value = mock_claude_result
+    mock_add_messages.side_effect = sqlite3.OperationalError("database is locked")
+    request_data = {"model": "sonnet", "messages": [{"role": "user", "content": "Hello"}]}
+
+    response = client.post("/v1/chat/completions", json=request_data)
+    assert response.status_code == 500
+    assert orjson.loads(response.content) == {"detail": "database is locked"}
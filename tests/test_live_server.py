@@ -1,39 +1,108 @@
+import os
+import re
+import shutil
 import pytest
 import httpx
-import json
-import asyncio
+import orjson
 import pytest_asyncio
 from typing import AsyncGenerator
+from unittest.mock import AsyncMock, patch
+from src.cache import DiskCache
+from src.claude_interface import HTTP2_AVAILABLE, _spawn, claude_interface
 
-BASE_URL = "http://localhost:8000"
+# --live target; point it at an https deployment to exercise HTTP/2
+BASE_URL = os.environ.get("CLAUDE_API_BASE_URL", "http://localhost:8000")
 
-@pytest_asyncio.fixture
-async def client():
-    async with httpx.AsyncClient(base_url=BASE_URL, timeout=30.0) as client:
-        yield client
+# Request bodies shared by several tests, serialized once; tests that need a
+# variation spread HELLO_REQUEST into a new dict
+HELLO_REQUEST = {"model": "sonnet", "messages": [{"role": "user", "content": "Hello"}]}
+HELLO_REQUEST_BYTES = orjson.dumps(HELLO_REQUEST)
+UNKNOWN_MODEL_REQUEST_BYTES = orjson.dumps({**HELLO_REQUEST, "model": "unknown-model"})
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Reads wait on Claude; everything else should be quick, so a stuck connect or
+# pool fails fast. Endpoints that never involve Claude get FAST_TIMEOUT.
+CLIENT_TIMEOUT = httpx.Timeout(connect=2.0, read=30.0, write=5.0, pool=5.0)
+FAST_TIMEOUT = 2.0
+
+# --offline/--record recordings of the claude CLI's output, one file per distinct call
+RECORDINGS_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "claude")
+
+# Payload of each SSE data line, matched directly on the received bytes
+SSE_DATA_RE = re.compile(rb"^data: (.*)$", re.M)
+
+# Every test and the shared client run on one session-wide event loop, so the
+# client's keep-alive pool (and its connections) outlive individual tests
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+@pytest_asyncio.fixture(scope="module", loop_scope="session")
+async def client(request, tmp_path_factory):
+    # Every completion here is a real (billed) Claude call, so the module only
+    # runs when asked to
+    live = request.config.getoption("--live")
+    offline = request.config.getoption("--offline")
+    record = request.config.getoption("--record")
+    if not (live or offline or record or request.config.getoption("--claude")):
+        pytest.skip("calls the real claude CLI; pass --claude, --offline, --record or --live")
+    if not (live or offline) and shutil.which("claude") is None:
+        pytest.skip("claude CLI is not installed")
+    
+    limits = httpx.Limits(max_keepalive_connections=100, max_connections=1000)
+    if live:
+        # HTTP/2 is negotiated via ALPN, so it only takes effect over TLS (uvicorn
+        # itself speaks HTTP/1.1); there concurrent tests share one connection
+        async with httpx.AsyncClient(base_url=BASE_URL, timeout=CLIENT_TIMEOUT, limits=limits, http2=HTTP2_AVAILABLE) as client:
+            yield client
+        return
+    
+    # By default the app is called in-process: no socket, no separately started
+    # server. ASGITransport skips the lifespan, so it is entered here, against a
+    # throwaway database. --offline answers from recordings of earlier runs and
+    # never starts the CLI, so a call with no recording fails; --record runs the
+    # CLI for those and saves what it returns.
+    from src.database import db_manager
+    from src.main import app
+    db_path = str(tmp_path_factory.mktemp("live") / "sessions.db")
+    replay_cache = DiskCache(RECORDINGS_DIR) if offline or record else None
+    spawn = AsyncMock(side_effect=RuntimeError("no --offline recording for this call; re-run with --record")) \
+        if offline and not record else _spawn
+    with patch.object(db_manager, "db_path", db_path), \
+            patch("src.claude_interface._spawn", spawn), \
+            patch.object(claude_interface, "_replay_cache", replay_cache or claude_interface._replay_cache):
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=CLIENT_TIMEOUT) as client:
+                yield client
+
+@pytest_asyncio.fixture(scope="module", loop_scope="session")
+async def alice_session(client):
+    """Response that opened a session introducing "Alice", shared by the session tests."""
+    return await client.post("/v1/chat/completions", json={
+        "model": "sonnet",
+        "messages": [{"role": "user", "content": "My name is Alice"}]
+    })
 
-@pytest.mark.asyncio
 async def test_server_health(client):
-    response = await client.get("/health")
+    response = await client.get("/health", timeout=FAST_TIMEOUT)
     assert response.status_code == 200
-    assert response.json() == {"status": "ok"}
+    assert orjson.loads(response.content) == {"status": "ok"}
 
-@pytest.mark.asyncio
 async def test_server_root(client):
-    response = await client.get("/")
+    response = await client.get("/", timeout=FAST_TIMEOUT)
     assert response.status_code == 200
-    assert response.json() == {"message": "Claude Code API Server"}
+    assert orjson.loads(response.content) == {"message": "Claude Code API Server"}
 
-@pytest.mark.asyncio
 async def test_openapi_docs(client):
-    response = await client.get("/docs")
+    # HEAD gives the same status and content type without the Swagger page body
+    response = await client.head("/docs", timeout=FAST_TIMEOUT)
     assert response.status_code == 200
     assert "text/html" in response.headers["content-type"]
 
-@pytest.mark.asyncio
-async def test_chat_completions_live(client):
+# One test per model name instead of a copy of the same request per model
+@pytest.mark.parametrize("model", ["sonnet", "opus", "claude-sonnet-4-20250514"])
+async def test_chat_completions_live(client, model):
     request_data = {
-        "model": "sonnet",
+        "model": model,
         "messages": [
             {"role": "user", "content": "Say hello in one word"}
         ],
@@ -43,16 +112,15 @@ async def test_chat_completions_live(client):
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
     
-    data = response.json()
+    data = orjson.loads(response.content)
     assert data["object"] == "chat.completion"
-    assert data["model"] == "sonnet"
+    assert data["model"] == model  # Should return requested model
     assert len(data["choices"]) == 1
     assert data["choices"][0]["message"]["role"] == "assistant"
     assert data["choices"][0]["message"]["content"]
     assert data["usage"]["prompt_tokens"] > 0
     assert data["usage"]["completion_tokens"] > 0
 
-@pytest.mark.asyncio
 async def test_chat_completions_streaming_live(client):
     request_data = {
         "model": "sonnet",
@@ -66,23 +134,25 @@ async def test_chat_completions_streaming_live(client):
         assert response.status_code == 200
         assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
         
-        chunks = []
-        async for chunk in response.aiter_text():
-            if chunk.strip() and chunk.startswith("data: "):
-                data_part = chunk[6:].strip()
-                if data_part != "[DONE]":
-                    try:
-                        chunk_data = json.loads(data_part)
-                        chunks.append(chunk_data)
-                    except json.JSONDecodeError:
-                        continue
+        # Reads are buffered until a whole event (ending in a blank line) is in,
+        # since one may be split across reads. Only the first frame is checked,
+        # so stop there; leaving the block closes the connection instead of
+        # waiting for the whole answer.
+        raw = bytearray()
+        async for data in response.aiter_bytes():
+            raw += data
+            if b"\n\n" in raw:
+                break
+        
+        first_chunk = None
+        match = SSE_DATA_RE.search(raw)
+        if match and match.group(1) != b"[DONE]":
+            first_chunk = orjson.loads(match.group(1))
         
-        assert len(chunks) > 0
-        first_chunk = chunks[0]
+        assert first_chunk is not None
         assert first_chunk["object"] == "chat.completion.chunk"
         assert first_chunk["model"] == "sonnet"
 
-@pytest.mark.asyncio
 async def test_chat_completions_validation_error_live(client):
     request_data = {
         "model": "sonnet",
@@ -93,31 +163,25 @@ async def test_chat_completions_validation_error_live(client):
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 422
 
-@pytest.mark.asyncio
 async def test_conversation_with_context(client):
-    messages = [
-        {"role": "user", "content": "My name is Alice"},
-        {"role": "assistant", "content": "Hello Alice! Nice to meet you."},
-        {"role": "user", "content": "What's my name?"}
-    ]
-    
     request_data = {
         "model": "sonnet",
-        "messages": messages,
+        "messages": [
+            {"role": "user", "content": "My name is Alice"},
+            {"role": "assistant", "content": "Hello Alice! Nice to meet you."},
+            {"role": "user", "content": "What's my name?"}
+        ],
         "max_tokens": 20
     }
     
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
-    
-    data = response.json()
-    assert data["choices"][0]["message"]["content"]
+    assert orjson.loads(response.content)["choices"][0]["message"]["content"]
 
-@pytest.mark.asyncio
 async def test_different_parameters(client):
     request_data = {
+        **HELLO_REQUEST,
         "model": "opus",
-        "messages": [{"role": "user", "content": "Hello"}],
         "temperature": 0.5,
         "max_tokens": 50,
         "top_p": 0.9
@@ -126,19 +190,14 @@ async def test_different_parameters(client):
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
     
-    data = response.json()
+    data = orjson.loads(response.content)
     assert data["model"] == "opus"
     assert data["choices"][0]["message"]["content"]
 
-@pytest.mark.asyncio
-async def test_session_persistence(client):
-    # First call - create session
-    response1 = await client.post("/v1/chat/completions", json={
-        "model": "sonnet",
-        "messages": [{"role": "user", "content": "My name is Alice"}]
-    })
-    assert response1.status_code == 200
-    session_id = response1.headers.get("X-Session-ID")
+async def test_session_persistence(client, alice_session):
+    # First call (the fixture) created the session
+    assert alice_session.status_code == 200
+    session_id = alice_session.headers.get("X-Session-ID")
     assert session_id is not None
     
     # Second call - use session
@@ -153,91 +212,37 @@ async def test_session_persistence(client):
     assert response2.headers.get("X-Session-ID") == session_id
     
     # Verify response shows awareness of previous context
-    data = response2.json()
+    data = orjson.loads(response2.content)
     content = data["choices"][0]["message"]["content"].lower()
     assert "alice" in content
 
-@pytest.mark.asyncio
-async def test_session_creation_without_header(client):
-    response = await client.post("/v1/chat/completions", json={
-        "model": "sonnet",
-        "messages": [{"role": "user", "content": "Hello"}]
-    })
-    assert response.status_code == 200
-    assert "X-Session-ID" in response.headers
+async def test_session_creation_without_header(alice_session):
+    # The shared session was opened by a request without X-Session-ID
+    assert alice_session.status_code == 200
+    assert "X-Session-ID" in alice_session.headers
 
-@pytest.mark.asyncio
 async def test_invalid_session_id(client):
-    response = await client.post("/v1/chat/completions",
-        headers={"X-Session-ID": "invalid-uuid"},
-        json={
-            "model": "sonnet", 
-            "messages": [{"role": "user", "content": "Hello"}]
-        }
-    )
+    # Only the session header handling is under test, so Claude itself is
+    # stubbed (this takes effect in-process; a --live server still calls it)
+    canned = {"type": "result", "is_error": False, "result": "Hi", "usage": {}}
+    with patch("src.claude_interface.claude_interface.complete_chat", AsyncMock(return_value=canned)):
+        response = await client.post("/v1/chat/completions",
+            headers={**JSON_HEADERS, "X-Session-ID": "invalid-uuid"},
+            content=HELLO_REQUEST_BYTES
+        )
     assert response.status_code == 200
     # Should create new session if invalid ID provided
     new_session_id = response.headers.get("X-Session-ID")
     assert new_session_id != "invalid-uuid"
 
-@pytest.mark.asyncio
-async def test_claude_model_aliases(client):
-    # Test Claude model aliases
-    response = await client.post("/v1/chat/completions", json={
-        "model": "opus",
-        "messages": [{"role": "user", "content": "What model are you?"}]
-    })
-    assert response.status_code == 200
-    data = response.json()
-    assert data["model"] == "opus"  # Should return requested model
-    
-@pytest.mark.asyncio
-async def test_full_claude_model_names(client):
-    # Test full Claude model names
-    response = await client.post("/v1/chat/completions", json={
-        "model": "claude-sonnet-4-20250514",
-        "messages": [{"role": "user", "content": "Hello"}]
-    })
-    assert response.status_code == 200
-    data = response.json()
-    assert data["model"] == "claude-sonnet-4-20250514"
-
-@pytest.mark.asyncio  
 async def test_unsupported_model_rejection(client):
     # Test unknown model names are rejected
-    response = await client.post("/v1/chat/completions", json={
-        "model": "unknown-model",
-        "messages": [{"role": "user", "content": "Hello"}]
-    })
+    response = await client.post("/v1/chat/completions", content=UNKNOWN_MODEL_REQUEST_BYTES, headers=JSON_HEADERS)
     # Should return 400 error for unsupported model
     assert response.status_code == 400
-    data = response.json()
+    data = orjson.loads(response.content)
     assert "not supported" in data["detail"]
 
-@pytest.mark.asyncio
-async def test_json_input_format(client):
-    # Test that JSON input format produces the same results as text input
-    request_data = {
-        "model": "sonnet",
-        "messages": [
-            {"role": "user", "content": "Say hello in one word"}
-        ],
-        "max_tokens": 10
-    }
-    
-    response = await client.post("/v1/chat/completions", json=request_data)
-    assert response.status_code == 200
-    
-    data = response.json()
-    assert data["object"] == "chat.completion"
-    assert data["model"] == "sonnet"
-    assert len(data["choices"]) == 1
-    assert data["choices"][0]["message"]["role"] == "assistant"
-    assert data["choices"][0]["message"]["content"]
-    assert data["usage"]["prompt_tokens"] > 0
-    assert data["usage"]["completion_tokens"] > 0
-
-@pytest.mark.asyncio
 async def test_system_message_support(client):
     # Test system message functionality - verify it doesn't crash
     request_data = {
@@ -252,14 +257,13 @@ async def test_system_message_support(client):
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
     
-    data = response.json()
+    data = orjson.loads(response.content)
     assert data["object"] == "chat.completion"
     assert data["model"] == "sonnet"
     assert len(data["choices"]) == 1
     assert data["choices"][0]["message"]["role"] == "assistant"
     assert data["choices"][0]["message"]["content"]  # Should have content
 
-@pytest.mark.asyncio
 async def test_system_message_with_session(client):
     # Test system message with session persistence
     response1 = await client.post("/v1/chat/completions", json={
@@ -281,13 +285,12 @@ async def test_system_message_with_session(client):
         }
     )
     assert response2.status_code == 200
-    data = response2.json()
+    data = orjson.loads(response2.content)
     content = data["choices"][0]["message"]["content"].lower()
     # Should maintain pirate persona from system message
     pirate_words = ["ahoy", "matey", "arr", "ye", "aye", "captain"]
     assert any(word in content for word in pirate_words)
 
-@pytest.mark.asyncio
 async def test_image_input_support(client):
     # Test image input with base64 data URL
     # Simple 1x1 red pixel PNG
@@ -310,7 +313,7 @@ async def test_image_input_support(client):
     response = await client.post("/v1/chat/completions", json=request_data)
     assert response.status_code == 200
     
-    data = response.json()
+    data = orjson.loads(response.content)
     assert data["object"] == "chat.completion"
     assert data["model"] == "sonnet"
     assert len(data["choices"]) == 1
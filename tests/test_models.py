@@ -7,6 +7,9 @@ from src.models.openai import (
     Role
 )
 
+# Validated once at import; tests that don't test construction share it
+HELLO_USER_MSG = ChatMessage(role=Role.USER, content="Hello")
+
 def test_chat_message_creation():
     message = ChatMessage(role=Role.USER, content="Hello")
     assert message.role == Role.USER
@@ -14,11 +17,10 @@ def test_chat_message_creation():
     assert message.name is None
 
 def test_chat_completion_request_basic():
-    request = ChatCompletionRequest(
+    # Only the defaults are under test here; validation has its own tests
+    request = ChatCompletionRequest.model_construct(
         model="gpt-3.5-turbo",
-        messages=[
-            ChatMessage(role=Role.USER, content="Hello")
-        ]
+        messages=[HELLO_USER_MSG]
     )
     assert request.model == "gpt-3.5-turbo"
     assert len(request.messages) == 1
@@ -36,7 +38,7 @@ def test_chat_completion_request_validation():
 def test_chat_completion_request_with_stream():
     request = ChatCompletionRequest(
         model="gpt-3.5-turbo",
-        messages=[ChatMessage(role=Role.USER, content="Hello")],
+        messages=[HELLO_USER_MSG],
         stream=True
     )
     assert request.stream is True
\ No newline at end of file